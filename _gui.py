@@ -24,6 +24,7 @@ __version__ = 20231228
 
 ### { HOUSEKEEPING
 import sys, os, os.path, time, logging, re, pickle, threading
+from functools import partial
 import tkinter as tk
 import tkinter.ttk as ttk
 import tkinter.messagebox as messagebox
@@ -145,6 +146,14 @@ class commalist(list):
     return [",".join(_) for _ in self]
 
 
+def pd_path_list(df_path):
+  ''' list of paths from a list, commalist or a comma separated string '''
+  if isinstance(df_path, commalist):
+    return df_path.split()
+  if isinstance(df_path, str):
+    return [_.strip() for _ in re.split(r'[,;]', df_path) if _.strip()]
+  return list(df_path)
+
 def table_name_selector(df_path, table_name = None):
   if table_name is None:
     m = re.match(r'^(.+)!(\w+)$', df_path)
@@ -207,7 +216,244 @@ def bmf_wait_lock(path, unlock = False, tries = None):
 
 ### { IO
 
-def pd_load_dataframe(df_path, condition = '', table_name = None, vl = None, keep_null = False):
+# columnar sidecar cache for slow to parse tabular formats
+# opt-in by passing cache_dir or setting the PD_CACHE_DIR environment variable
+pd_cache_re = r'(csv|asc|prn|txt|xls\w?)$'
+
+def pd_cache_path(df_path, table_name = None, cache_dir = None):
+  ''' sidecar path, with a prefix from the source path and a suffix from its mtime and size '''
+  import hashlib
+  st = os.stat(df_path)
+  k = hashlib.sha1(('%s!%s' % (os.path.abspath(df_path).lower(), table_name)).encode()).hexdigest()[:16]
+  f = hashlib.sha1(('%d:%d' % (st.st_mtime_ns, st.st_size)).encode()).hexdigest()[:16]
+  return os.path.join(cache_dir, '%s_%s.feather' % (k, f))
+
+def pd_cache_load(df_path, table_name = None, cache_dir = None, columns = None):
+  cache_path = pd_cache_path(df_path, table_name, cache_dir)
+  if not os.path.exists(cache_path):
+    return None
+  import pyarrow.feather
+  if columns is not None:
+    names = pyarrow.feather.read_table(cache_path, columns=[], memory_map=True).schema.names
+    columns = [_ for _ in names if _ in columns]
+  # uncompressed feather files are memory mapped instead of parsed
+  return pyarrow.feather.read_table(cache_path, columns=columns, memory_map=True).to_pandas()
+
+def pd_cache_chunks(df_path, table_name = None, cache_dir = None, columns = None):
+  ''' yield the record batches of a columnar cache entry as dataframes '''
+  import pyarrow as pa
+  with pa.memory_map(pd_cache_path(df_path, table_name, cache_dir)) as source:
+    reader = pa.ipc.open_file(source)
+    names = reader.schema.names
+    if columns is not None:
+      names = [_ for _ in names if _ in columns]
+    n = 0
+    for i in range(reader.num_record_batches):
+      df = reader.get_batch(i).select(names).to_pandas()
+      df.index += n
+      n += len(df)
+      yield df
+
+def pd_cache_save(df, df_path, table_name = None, cache_dir = None):
+  import glob
+  cache_path = pd_cache_path(df_path, table_name, cache_dir)
+  os.makedirs(cache_dir, exist_ok=True)
+  # invalidate stale entries for the same source
+  for p in glob.glob(cache_path[:-25] + '_*.feather'):
+    if p != cache_path:
+      os.remove(p)
+  try:
+    import pyarrow.feather
+    df = df.reset_index(drop=True)
+    df.columns = df.columns.astype(str)
+    pyarrow.feather.write_feather(df, cache_path + '.tmp', compression='uncompressed')
+    os.replace(cache_path + '.tmp', cache_path)
+  except Exception as e:
+    log('columnar cache skipped', df_path, e)
+    if os.path.exists(cache_path + '.tmp'):
+      os.remove(cache_path + '.tmp')
+    return None
+  return cache_path
+
+def pd_cache_warm(dir_path, cache_dir = None):
+  ''' pre load every supported sample database in a directory into the columnar cache '''
+  if cache_dir is None:
+    cache_dir = os.environ.get('PD_CACHE_DIR', os.path.join(dir_path, '.pd_cache'))
+  r = []
+  for root, dirs, files in os.walk(dir_path):
+    dirs[:] = [_ for _ in dirs if not _.startswith('.')]
+    for f in files:
+      if re.search(pd_cache_re, f, re.IGNORECASE) and not f.startswith('~$'):
+        t = time.perf_counter()
+        df = pd_load_dataframe(os.path.join(root, f), keep_null = True, cache_dir = cache_dir, columns = [])
+        log('cached', os.path.join(root, f), df.shape, '%.3fs' % (time.perf_counter() - t))
+        r.append(os.path.join(root, f))
+  return r
+
+# csv dialects detected so far, keyed on path, mtime and size
+_csv_dialect = {}
+
+def pd_sniff_csv(df_path, size = 65536):
+  ''' detect delimiter and encoding from the head of a text file, once per file version '''
+  import csv, codecs
+  st = os.stat(df_path)
+  k = (os.path.abspath(df_path), st.st_mtime_ns, st.st_size)
+  if k not in _csv_dialect:
+    with open(df_path, 'rb') as f:
+      b = f.read(size)
+    encoding = 'latin_1'
+    if b.startswith(codecs.BOM_UTF8):
+      encoding = 'utf_8_sig'
+    else:
+      try:
+        b.decode('utf_8')
+        encoding = 'utf_8'
+      except UnicodeDecodeError as e:
+        # the sample may end in the middle of a multibyte character
+        if e.start >= len(b) - 3 and e.reason == 'unexpected end of data':
+          encoding = 'utf_8'
+    lines = b.decode(encoding, 'ignore').splitlines()
+    if len(b) == size and len(lines) > 1:
+      # last line is probably truncated
+      lines.pop()
+    sep = ','
+    try:
+      sep = csv.Sniffer().sniff('\n'.join(lines[:100]), ',;\t| ').delimiter
+    except csv.Error:
+      pass
+    if sep == ' ':
+      sep = r'\s+'
+    _csv_dialect[k] = (sep, encoding)
+  return _csv_dialect[k]
+
+def pd_read_csv(df_path, usecols = None, chunksize = None, nrows = None, engine = None):
+  '''
+  read_csv using a sniffed dialect, avoiding the slow sep=None python engine
+  engine: c (default) or pyarrow, which can not read in chunks
+  chunksize: return a iterator of dataframes
+  '''
+  import pandas as pd
+  sep, encoding = pd_sniff_csv(df_path)
+  if callable(usecols):
+    usecols = [_ for _ in pd.read_csv(df_path, sep=sep, encoding=encoding, encoding_errors='replace', nrows=0).columns if usecols(_)]
+  if engine is None or chunksize or nrows is not None:
+    engine = 'c'
+  return pd.read_csv(df_path, sep=sep, encoding=encoding, encoding_errors='replace', usecols=usecols, chunksize=chunksize, nrows=nrows, engine=engine)
+
+def pd_condition_fields(condition):
+  ''' names that a query condition may reference, including keywords and literals '''
+  if not condition:
+    return []
+  return [_.strip('`') for _ in re.findall(r'`[^`]+`|[^\W\d]\w*', condition)]
+
+def pd_memory(df):
+  return int(df.memory_usage(deep=True).sum())
+
+def pd_mask_null(df, null_values = None):
+  '''
+  replace sentinel values with NaN, column by column and only on numeric columns
+  null_values: list of sentinels for all fields
+  or dict of field: list of sentinels, where the key '*' is the default for other fields
+  ex.: {'*': [-99, -999], 'grade1': [-99, 0]}
+  '''
+  import pandas as pd
+  if null_values is None:
+    null_values = [-99]
+  for c in df.columns:
+    v = null_values
+    if isinstance(null_values, dict):
+      v = null_values.get(c, null_values.get('*', []))
+    if not v:
+      continue
+    s = df[c]
+    if not pd.api.types.is_numeric_dtype(s) or pd.api.types.is_bool_dtype(s):
+      continue
+    m = s.isin(v)
+    if m.any():
+      # integer columns become float
+      df[c] = s.mask(m)
+  return df
+
+def pd_compact(df, categories = None, float32 = None, rtol = 1e-6, max_ratio = 0.5):
+  '''
+  compact representation of a table
+  categories: fields converted to categorical
+  default is every text field with at most max_ratio distinct values per row
+  float32: list of fields (or True for all numeric fields) downcast to float32
+  a field is only downcast if all values stay within the relative tolerance rtol
+  '''
+  import numpy as np
+  import pandas as pd
+  for c in df.columns:
+    s = df[c]
+    if isinstance(s.dtype, pd.CategoricalDtype):
+      continue
+    if categories is None:
+      if (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s)) and s.nunique() <= max_ratio * len(s):
+        df[c] = s.astype('category')
+    elif c in categories:
+      df[c] = s.astype('category')
+    if float32 is True or (float32 and c in float32):
+      if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s) and s.dtype != np.float32:
+        s32 = s.astype(np.float32)
+        if np.allclose(s32.values, s.values, rtol=rtol, atol=0, equal_nan=True):
+          df[c] = s32
+        else:
+          log(c, 'not downcast to float32, tolerance', rtol, 'exceeded')
+  return df
+
+def pd_iter_chunks(chunks, columns = None, condition = '', keep_null = False, null_values = None):
+  ''' mask nulls and apply the condition to each chunk as it is read, keeping only the requested columns '''
+  m = [0, 0]
+  for df in chunks:
+    if not int(keep_null):
+      m[0] += pd_memory(df)
+      df = pd_mask_null(df, null_values)
+      m[1] += pd_memory(df)
+    if len(condition):
+      df = df.query(condition)
+    if columns is not None:
+      df = df[[_ for _ in columns if _ in df]]
+    yield df
+  if m[0]:
+    log('null mask memory %.1f MB -> %.1f MB' % (m[0] / 2**20, m[1] / 2**20))
+
+def pd_filter_chunks(chunks, columns = None, condition = '', keep_null = False, null_values = None):
+  import pandas as pd
+  r = list(pd_iter_chunks(chunks, columns, condition, keep_null, null_values))
+  if len(r) == 0:
+    return pd.DataFrame(columns=columns)
+  return pd.concat(r)
+
+def pd_iter_dataframe(df_path, condition = '', table_name = None, columns = None, chunksize = 100000, null_values = None, cache_dir = None):
+  '''
+  yield a table in chunks of up to chunksize rows, for data that does not fit in memory
+  csv, xlsx and the columnar cache are streamed, other formats are yielded whole
+  '''
+  if condition is None:
+    condition = ''
+  if table_name is None:
+    df_path, table_name = table_name_selector(df_path)
+  if cache_dir is None:
+    cache_dir = os.environ.get('PD_CACHE_DIR')
+  fields = None
+  if columns is not None:
+    fields = list(columns) + [_ for _ in pd_condition_fields(condition) if _ not in columns]
+  chunks = None
+  if not os.path.exists(df_path):
+    pass
+  elif cache_dir and re.search(pd_cache_re, df_path, re.IGNORECASE) and os.path.exists(pd_cache_path(df_path, table_name, cache_dir)):
+    chunks = pd_cache_chunks(df_path, table_name, cache_dir, fields)
+  elif re.search(r'(csv|asc|prn|txt)$', df_path, re.IGNORECASE):
+    chunks = pd_read_csv(df_path, fields and (lambda _: _ in fields), chunksize)
+  elif re.search(r'xls\w?$', df_path, re.IGNORECASE) and not df_path.lower().endswith('.xls'):
+    chunks = pd_iter_excel(df_path, table_name, chunksize, fields)
+  if chunks is None:
+    yield pd_load_dataframe(df_path, condition, table_name, columns = columns, null_values = null_values, cache_dir = cache_dir)
+  else:
+    yield from pd_iter_chunks(chunks, columns, condition, False, null_values)
+
+def pd_load_dataframe(df_path, condition = '', table_name = None, vl = None, keep_null = False, cache_dir = None, columns = None, chunksize = 100000, null_values = None, compact = None):
   '''
   convenience function to return a dataframe based on the input file extension
   csv: ascii tabular data
@@ -218,6 +464,11 @@ def pd_load_dataframe(df_path, condition = '', table_name = None, vl = None, kee
   00t: vulcan triangulation
   dm: datamine generic database
   shp: ESRI shape file
+  csv and xls are stored in a columnar cache if cache_dir (or env PD_CACHE_DIR) is set
+  columns: load only these fields
+  null_values: sentinels replaced by NaN on numeric fields, see pd_mask_null. default -99
+  compact: True or dict of arguments to pd_compact (categorical text, float32)
+  csv, xls and the columnar cache read in chunks of chunksize rows, filtered by condition
   '''
   import pandas as pd
   # early exit for cases where a script is calling another
@@ -225,14 +476,43 @@ def pd_load_dataframe(df_path, condition = '', table_name = None, vl = None, kee
     return df_path
   if table_name is None:
     df_path, table_name = table_name_selector(df_path)
+  if condition is None:
+    condition = ''
+  if cache_dir is None:
+    cache_dir = os.environ.get('PD_CACHE_DIR')
+  # fields to read: the projection plus anything the condition needs
+  fields = None
+  if columns is not None:
+    fields = list(columns) + [_ for _ in pd_condition_fields(condition) if _ not in columns]
   df = None
-  if not os.path.exists(df_path):
+  chunks = None
+  if cache_dir and os.path.exists(df_path) and re.search(pd_cache_re, df_path, re.IGNORECASE):
+    if not os.path.exists(pd_cache_path(df_path, table_name, cache_dir)):
+      df = pd_load_dataframe(df_path, '', table_name, vl, True, '')
+      if pd_cache_save(df, df_path, table_name, cache_dir):
+        df = None
+    if df is not None:
+      pass
+    elif len(condition):
+      chunks = pd_cache_chunks(df_path, table_name, cache_dir, fields)
+    else:
+      df = pd_cache_load(df_path, table_name, cache_dir, fields)
+  elif not os.path.exists(df_path):
     print(df_path,"not found")
     df = pd.DataFrame()
   elif re.search(r'(csv|asc|prn|txt)$', df_path, re.IGNORECASE):
-    df = pd.read_csv(df_path, sep=None, engine='python', encoding='latin_1')
+    usecols = None
+    if fields is not None:
+      usecols = lambda _: _ in fields
+    if len(condition):
+      chunks = pd_read_csv(df_path, usecols, chunksize)
+    else:
+      df = pd_read_csv(df_path, usecols)
   elif re.search(r'xls\w?$', df_path, re.IGNORECASE):
-    df = pd_load_excel(df_path, table_name)
+    if len(condition) and not df_path.lower().endswith('.xls'):
+      chunks = pd_iter_excel(df_path, table_name, chunksize, fields)
+    else:
+      df = pd_load_excel(df_path, table_name, fields)
   elif df_path.lower().endswith('bmf'):
     df = pd_load_bmf(df_path, condition, vl)
     condition = ''
@@ -282,13 +562,53 @@ def pd_load_dataframe(df_path, condition = '', table_name = None, vl = None, kee
   else:
     df = pd.DataFrame()
 
-  if not int(keep_null):
-    df.mask(df == -99, inplace=True)
+  if chunks is not None:
+    df = pd_filter_chunks(chunks, columns, condition, keep_null, null_values)
+    if compact:
+      df = pd_compact(df, **(compact if isinstance(compact, dict) else {}))
+    return df
 
   # replace -99 with NaN, meaning they will not be included in the stats
+  if not int(keep_null):
+    m = pd_memory(df)
+    pd_mask_null(df, null_values)
+    log('null mask memory %.1f MB -> %.1f MB' % (m / 2**20, pd_memory(df) / 2**20))
+
   if len(condition):
     df.query(condition, inplace=True)
 
+  if columns is not None:
+    df = df[[_ for _ in columns if _ in df]]
+
+  if compact:
+    m = pd_memory(df)
+    df = pd_compact(df, **(compact if isinstance(compact, dict) else {}))
+    log('compact memory %.1f MB -> %.1f MB' % (m / 2**20, pd_memory(df) / 2**20))
+
+  return df
+
+def pd_load_dataframes(df_paths, condition = '', processes = None, **kwargs):
+  '''
+  load multiple files of any supported format in a process pool
+  rows are tagged with the source file name in the filename field
+  and concatenated into a single table with the union of all columns
+  '''
+  import pandas as pd
+  from concurrent.futures import ProcessPoolExecutor
+  df_paths = pd_path_list(df_paths)
+  if len(df_paths) <= 1 or processes == 1:
+    dfs = [pd_load_dataframe(_, condition, **kwargs) for _ in df_paths]
+  else:
+    with ProcessPoolExecutor(min(processes or os.cpu_count(), len(df_paths))) as pool:
+      dfs = list(pool.map(partial(pd_load_dataframe, condition = condition, **kwargs), df_paths))
+  for i in range(len(dfs)):
+    dfs[i] = dfs[i].assign(filename=os.path.basename(table_name_selector(df_paths[i])[0]))
+  if len(dfs) == 0:
+    return pd.DataFrame()
+  df = pd.concat(dfs, ignore_index=True)
+  if kwargs.get('compact'):
+    # categories of each file differ, so they must be rebuilt on the union
+    df = pd_compact(df, **(kwargs['compact'] if isinstance(kwargs['compact'], dict) else {}))
   return df
 
 def pd_synonyms(df, synonyms, default = 0):
@@ -910,14 +1230,14 @@ def dm_field_list(file_path):
 def excel_field_list(df_path, table_name, alternate = False):
   r = []
   try:
-    import openpyxl
-    wb = openpyxl.load_workbook(df_path)
     if alternate:
+      import openpyxl
+      # read only mode parses only the rows we iterate
+      wb = openpyxl.load_workbook(df_path, read_only=True)
       r = wb.sheetnames
-    elif table_name and table_name in wb:
-      r = next(wb[table_name].values)
+      wb.close()
     else:
-      r = next(wb.active.values)
+      r = excel_header(df_path, table_name)
   except:
     print("openpyxl not available")
     import pandas as pd
@@ -925,17 +1245,68 @@ def excel_field_list(df_path, table_name, alternate = False):
   
   return r
 
-def pd_from_openpyxl(ws):
-  import pandas as pd
-  data = ws.values
-  cols = list(next(data))
+def excel_worksheet(wb, table_name = None):
+  if table_name and table_name in wb:
+    return wb[table_name]
+  return wb.active
+
+def openpyxl_columns(cols):
+  # blank headers are named by their column index
+  cols = [i if cols[i] is None else cols[i] for i in range(len(cols))]
   # handle duplicate columns
   for i in range(len(cols)):
     for j in range(i-1,-1,-1):
       if cols[i] == cols[j]:
-        cols[i] += '.' + str(i)
+        cols[i] = '%s.%d' % (cols[i], i)
+  return cols
+
+def pd_from_openpyxl(ws):
+  import pandas as pd
+  data = ws.values
+  cols = openpyxl_columns(next(data))
+
+  return pd.DataFrame(data, columns=cols)
 
-  return pd.DataFrame(data, columns=[i if cols[i] is None else cols[i] for i in range(len(cols))])  
+def excel_header(df_path, table_name = None):
+  ''' column names from the first row of a worksheet, without parsing the rest '''
+  import openpyxl
+  wb = openpyxl.load_workbook(df_path, read_only=True, data_only=True)
+  try:
+    return openpyxl_columns(next(excel_worksheet(wb, table_name).values, ()))
+  finally:
+    wb.close()
+
+def pd_iter_excel(df_path, table_name = None, chunksize = 100000, columns = None):
+  '''
+  stream a worksheet as dataframes of up to chunksize rows
+  uses a read only, values only workbook so memory is bound by the chunk size
+  empty rows are skipped
+  '''
+  import openpyxl
+  import pandas as pd
+  wb = openpyxl.load_workbook(df_path, read_only=True, data_only=True)
+  try:
+    rows = excel_worksheet(wb, table_name).iter_rows(values_only=True)
+    cols = openpyxl_columns(next(rows, ()))
+    sel = [i for i in range(len(cols)) if columns is None or cols[i] in columns]
+    names = [cols[i] for i in sel]
+    n = 0
+    data = []
+    for row in rows:
+      if len(row) < len(cols):
+        row = row + (None,) * (len(cols) - len(row))
+      row = [row[i] for i in sel]
+      if not any([_ is not None for _ in row]):
+        continue
+      data.append(row)
+      if len(data) >= chunksize:
+        yield pd.DataFrame.from_records(data, index=range(n, n + len(data)), columns=names)
+        n += len(data)
+        data = []
+    if len(data) or n == 0:
+      yield pd.DataFrame.from_records(data, index=range(n, n + len(data)), columns=names)
+  finally:
+    wb.close()
 
 def pd_load_excel_350(df_path, table_name):
   import openpyxl
@@ -948,7 +1319,7 @@ def pd_load_excel_350(df_path, table_name):
   # handle duplicated columns
   return pd_from_openpyxl(ws)
 
-def pd_load_excel(df_path, table_name = None):
+def pd_load_excel(df_path, table_name = None, columns = None):
   if sys.hexversion < 0x3060000:
     return pd_load_excel_350(df_path, table_name)
   import pandas as pd
@@ -959,7 +1330,15 @@ def pd_load_excel(df_path, table_name = None):
     engine = None
   if not table_name:
     table_name = None
-  df = pd.read_excel(df_path, table_name, engine=engine)
+  if engine == 'openpyxl':
+    # streamed, only the requested columns are materialized
+    df = pd.concat(pd_iter_excel(df_path, table_name, columns=columns))
+    # a column may be all empty in some chunks
+    return df.infer_objects()
+  usecols = None
+  if columns is not None:
+    usecols = lambda _: _ in columns
+  df = pd.read_excel(df_path, table_name, engine=engine, usecols=usecols)
   if not isinstance(df, pd.DataFrame):
     _, df = df.popitem()
 
@@ -1679,7 +2058,7 @@ class smartfilelist(object):
         elif input_ext == ".msh" and s == 0:
           r = smartfilelist.default_columns + ['closed','node']
         elif input_ext == ".csv":
-          df = pd.read_csv(df_path, sep=None, engine='python', encoding='latin_1', nrows=s == 0 and 1 or None)
+          df = pd_read_csv(df_path, nrows=s == 0 and 1 or None)
           if s == 0:
             r = df.columns.tolist()
           if s == 1:
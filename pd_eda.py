@@ -0,0 +1,826 @@
+#!python
+# vectorized engines for the wf_eda steps
+
+import os, atexit, threading, weakref
+import numpy as np
+import pandas as pd
+
+def eda_columns(form, key = 'sample_db'):
+  ''' columns of the sample table used by the eda steps: lito, length, grades and xyz '''
+  from _gui import pd_detect_xyz, pd_path_list, smartfilelist
+  r = []
+  for k in ['lito_field', 'length_field', 'grade_fields']:
+    v = form.get(k)
+    if isinstance(v, str):
+      v = [v]
+    if v:
+      r.extend([_ for _ in v if _ not in r])
+  # multiple files: the first one is representative
+  xyz = pd_detect_xyz(pd.DataFrame(columns=smartfilelist.get((pd_path_list(form.get(key)) + [''])[0])))
+  if xyz:
+    r.extend([_ for _ in xyz if _ not in r])
+  return r
+
+def eda_compact(form):
+  ''' pd_compact settings from the form: categorical lito and float32 grades '''
+  if not form.get('compact'):
+    return None
+  return {'float32': list(form.get('grade_fields'))}
+
+def quantile_labels(quantiles):
+  ''' q1 q2 q3 for quartiles, p<percent> otherwise '''
+  if list(quantiles) == [0.25, 0.5, 0.75]:
+    return ['q1', 'q2', 'q3']
+  return ['p%g' % (_ * 100) for _ in quantiles]
+
+# shared memory block attached by each pool worker
+_shm = None
+_shm_array = None
+
+def _shm_apply(name, shape, fn, start, end, args):
+  global _shm, _shm_array
+  if _shm is None or _shm.name != name:
+    from multiprocessing import shared_memory
+    if _shm is not None:
+      _shm_array = None
+      _shm.close()
+    _shm = shared_memory.SharedMemory(name=name)
+    _shm_array = np.ndarray(shape, np.float64, buffer=_shm.buf)
+  return fn(_shm_array[start:end], *args)
+
+# pool and last table block kept between pd_group_map calls, so the statistics,
+# bootstrap and correlation of the same table share one pool and one shared memory copy
+# the block only holds a weak reference to its table, and is freed with it
+_group_lock = threading.Lock()
+_group_pool = None
+_group_block = None
+
+def _group_drop(ref = None):
+  ''' free the shared memory block, if ref only when it belongs to that table '''
+  global _group_block
+  b = _group_block
+  if b is not None and (ref is None or b[0] is ref):
+    _group_block = None
+    b[2].close()
+    b[2].unlink()
+
+def _group_release():
+  global _group_pool
+  _group_drop()
+  if _group_pool is not None:
+    _group_pool[1].shutdown()
+    _group_pool = None
+
+atexit.register(_group_release)
+
+def _group_table(df, group, fields, shm):
+  ''' group order of the rows and the (rows, fields) float64 array sorted by group, in shared memory if shm '''
+  from multiprocessing import shared_memory
+  codes, uniques = pd.factorize(df[group], sort=True)
+  o = np.argsort(codes, kind='stable')
+  o = o[codes[o] >= 0]
+  n = np.bincount(codes[o], minlength=len(uniques))
+  shape = (len(o), len(fields))
+  b = None
+  if shm:
+    b = shared_memory.SharedMemory(create=True, size=max(1, shape[0] * shape[1] * 8))
+    a = np.ndarray(shape, np.float64, buffer=b.buf)
+  else:
+    a = np.empty(shape)
+  for j in range(len(fields)):
+    a[:, j] = df[fields[j]].to_numpy(np.float64, na_value=np.nan)[o]
+  return uniques, np.cumsum(n) - n, n, a, b
+
+def pd_group_map(df, group, fields, fn, processes = None, *args):
+  '''
+  call fn(values, *args) for the rows of each group, where values is a (rows, fields) float64 array
+  the table is sorted by group once into shared memory, and pool workers read their group
+  as a slice of it instead of receiving a pickled copy. fn must be a module level function
+  the pool and the block of the last table are reused by the next call on the same table
+  processes: pool size, default is the cpu count. 1 runs serially in this process
+  returns a dict of group: result
+  '''
+  global _group_pool, _group_block
+  from concurrent.futures import ProcessPoolExecutor
+  fields = list(fields)
+  if processes is None:
+    processes = os.cpu_count()
+  if processes <= 1 or df[group].nunique() <= 1:
+    uniques, start, n, a, _ = _group_table(df, group, fields, False)
+    return {uniques[i]: fn(a[start[i]:start[i] + n[i]], *args) for i in range(len(uniques))}
+  with _group_lock:
+    key = (group, tuple(fields))
+    if _group_block is None or _group_block[0]() is not df or _group_block[1] != key:
+      _group_drop()
+      uniques, start, n, a, b = _group_table(df, group, fields, True)
+      del a
+      _group_block = (weakref.ref(df, _group_drop), key, b, (int(n.sum()), len(fields)), uniques, start, n)
+    _, _, b, shape, uniques, start, n = _group_block
+    if _group_pool is None or _group_pool[0] != processes:
+      if _group_pool is not None:
+        _group_pool[1].shutdown()
+      _group_pool = (processes, ProcessPoolExecutor(processes))
+    pool = _group_pool[1]
+    # largest groups first, so the pool stays balanced
+    fs = {i: pool.submit(_shm_apply, b.name, shape, fn, start[i], start[i] + n[i], args) for i in np.argsort(-n)}
+    return {uniques[i]: fs[i].result() for i in range(len(uniques))}
+
+def block_stats(a, quantiles):
+  ''' (fields, stats) array for a (rows, fields) block: count, mean, min, max, var, std, quantiles '''
+  import warnings
+  with warnings.catch_warnings():
+    # all nan fields are expected
+    warnings.simplefilter('ignore', RuntimeWarning)
+    var = np.nanvar(a, 0, ddof=1)
+    r = [np.sum(~np.isnan(a), 0), np.nanmean(a, 0), np.nanmin(a, 0), np.nanmax(a, 0), var, np.sqrt(var)]
+    if len(quantiles):
+      r.extend(np.nanquantile(a, quantiles, 0))
+  return np.transpose(r)
+
+def pd_grouped_stats(df, group, fields, quantiles = (0.25, 0.5, 0.75), processes = None):
+  '''
+  count, mean, min, max, var, std and quantiles of all fields per group
+  a single groupby for the moments and a single multi quantile call,
+  which sorts each group of each field once for all quantiles
+  processes: if more than 1, groups are computed in a process pool with pd_group_map
+  returns a table indexed by group with (field, statistic) columns
+  '''
+  fields = list(fields)
+  stats = ['count', 'mean', 'min', 'max', 'var', 'std'] + quantile_labels(quantiles)
+  if not df[group].notna().any():
+    # groupby agg fails without groups
+    return pd.DataFrame(index=pd.Index([], name=group), columns=pd.MultiIndex.from_product([fields, stats]), dtype=np.float64)
+  if processes is not None and processes > 1:
+    r = pd_group_map(df, group, fields, block_stats, processes, list(quantiles))
+    return pd.DataFrame([r[k].ravel() for k in r], pd.Index(list(r), name=group), pd.MultiIndex.from_product([fields, stats]))
+  g = df.groupby(group, observed=True, sort=True)[fields]
+  r = g.agg(['count', 'mean', 'min', 'max', 'var', 'std'])
+  if len(quantiles):
+    q = g.quantile(list(quantiles)).unstack(-1)
+    q.columns = pd.MultiIndex.from_tuples([(f, quantile_labels(quantiles)[list(quantiles).index(_)]) for f,_ in q.columns])
+    r = pd.concat([r, q], axis=1)
+  return r.reindex(columns=pd.MultiIndex.from_product([fields, stats]))
+
+def pd_weighted_stats(df, group, fields, weight, quantiles = (0.25, 0.5, 0.75)):
+  '''
+  weighted sum of weights, mean, variance, std and quantiles of all fields per group
+  each field is sorted once by (group, value) and the quantiles are found on the
+  cumulative weights with searchsorted, so there are no loops over groups
+  the quantile is the lowest value where the cumulative weight reaches q of the group total
+  returns a table indexed by group with (field, statistic) columns, prefixed with w
+  '''
+  codes, uniques = pd.factorize(df[group], sort=True)
+  ng = len(uniques)
+  # small integers are sorted by radix when stable
+  codes = codes.astype(np.int16 if ng < 2**15 else np.int64)
+  wa = df[weight].to_numpy(np.float64, na_value=np.nan)
+  labels = ['wsum', 'wmean', 'wvar', 'wstd'] + ['w' + _ for _ in quantile_labels(quantiles)]
+  r = {}
+  for f in fields:
+    v = df[f].to_numpy(np.float64, na_value=np.nan)
+    ok = (codes >= 0) & np.isfinite(v) & np.isfinite(wa) & (wa > 0)
+    c = codes[ok]
+    x = v[ok]
+    w = wa[ok]
+    # ties in value may come in any order, the group order must be stable
+    o = np.argsort(x)
+    o = o[np.argsort(c[o], kind='stable')]
+    c = c[o]
+    x = x[o]
+    w = w[o]
+    n = np.bincount(c, minlength=ng)
+    ws = np.bincount(c, w, ng)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      mean = np.bincount(c, w * x, ng) / ws
+      var = np.bincount(c, w * np.square(x - mean[c]), ng) / ws
+    s = [ws, mean, var, np.sqrt(var)]
+    if len(x):
+      cw = np.cumsum(w)
+      start = np.cumsum(n) - n
+      end = np.maximum(start + n - 1, 0)
+      start = np.minimum(start, len(x) - 1)
+      base = cw[start] - w[start]
+      for q in quantiles:
+        i = np.minimum(np.searchsorted(cw, base + q * ws), end)
+        s.append(np.where(n > 0, x[i], np.nan))
+    else:
+      s.extend([np.full(ng, np.nan)] * len(quantiles))
+    for i in range(len(labels)):
+      r[(f, labels[i])] = s[i]
+  return pd.DataFrame(r, index=pd.Index(uniques, name=group))
+
+def stat_quantile(stat):
+  ''' quantile of a statistic label: q1 q2 q3 or p<percent> '''
+  if stat in ('q1', 'q2', 'q3'):
+    return int(stat[1]) * 0.25
+  return float(stat[1:]) / 100
+
+def block_bootstrap(a, stats = ('mean', 'q2'), resamples = 1000, alpha = 0.05, seed = None, max_mb = 256):
+  '''
+  percentile bootstrap confidence intervals for each field of a (rows, fields) block
+  resamples are drawn as a 2d array of indices, (b resamples, n rows) at a time,
+  with b as large as the max_mb memory cap allows for the indices plus the values
+  returns a (fields, stats * 2) array with the low and high bound of each statistic
+  '''
+  rng = np.random.default_rng(seed)
+  qs = [stat_quantile(_) for _ in stats if _ != 'mean']
+  r = []
+  for j in range(a.shape[1]):
+    x = a[:, j]
+    x = x[~np.isnan(x)]
+    n = len(x)
+    if n == 0:
+      r.append([np.nan] * len(stats) * 2)
+      continue
+    b = int(max(1, min(resamples, max_mb * 2**20 // (n * 16))))
+    d = []
+    for i in range(0, resamples, b):
+      s = x[rng.integers(0, n, (min(b, resamples - i), n))]
+      e = []
+      if 'mean' in stats:
+        e.append(s.mean(1))
+      if len(qs):
+        e.extend(np.quantile(s, qs, 1))
+      d.append(np.transpose(e))
+    d = np.concatenate(d)
+    # same order as stats
+    d = d[:, [0 if _ == 'mean' else ('mean' in stats) + qs.index(stat_quantile(_)) for _ in stats]]
+    lo, hi = np.quantile(d, [alpha * 0.5, 1 - alpha * 0.5], 0)
+    r.append(np.ravel(np.transpose([lo, hi])))
+  return np.asarray(r)
+
+def pd_bootstrap_ci(df, group, fields, stats = ('mean', 'q2'), resamples = 1000, alpha = 0.05, seed = None, processes = 1, max_mb = 256):
+  '''
+  bootstrap confidence intervals of statistics per group, see block_bootstrap
+  returns a table indexed by group with (field, <stat>_lo) and (field, <stat>_hi) columns
+  '''
+  fields = list(fields)
+  r = pd_group_map(df, group, fields, block_bootstrap, processes, stats, resamples, alpha, seed, max_mb)
+  labels = [_ + b for _ in stats for b in ['_lo', '_hi']]
+  return pd.DataFrame([r[k].ravel() for k in r], pd.Index(list(r), name=group), pd.MultiIndex.from_product([fields, labels]))
+
+def pairwise_corr(a, chunksize = 65536):
+  '''
+  pearson correlation of the columns of a (rows, fields) array, each pair on the rows where both are valid
+  the pairwise sums come from masked matrix products, so there are no loops over pairs
+  rows are accumulated in chunks to bound the temporary arrays
+  '''
+  f = a.shape[1]
+  # centering first avoids cancellation in the sums of squares
+  with np.errstate(invalid='ignore'):
+    mean = np.nan_to_num(np.nanmean(a, 0)) if len(a) else np.zeros(f)
+  n = np.zeros((f, f))
+  # sx[i, j] is the sum of field i on the rows where j is also valid
+  sx = np.zeros((f, f))
+  sxx = np.zeros((f, f))
+  sxy = np.zeros((f, f))
+  for i in range(0, len(a), chunksize):
+    m = ~np.isnan(a[i:i + chunksize])
+    x = np.where(m, a[i:i + chunksize] - mean, 0.0)
+    if m.all():
+      # no missing values in this chunk, the masked products reduce to column sums
+      n += len(m)
+      sx += x.sum(0)[:, None]
+      sxx += (x * x).sum(0)[:, None]
+    else:
+      m = m.astype(np.float64)
+      n += m.T @ m
+      sx += x.T @ m
+      sxx += (x * x).T @ m
+    sxy += x.T @ x
+  with np.errstate(invalid='ignore', divide='ignore'):
+    cov = sxy - sx * sx.T / n
+    vx = sxx - sx * sx / n
+    r = cov / np.sqrt(vx * vx.T)
+  r[n < 2] = np.nan
+  return np.clip(r, -1, 1)
+
+def block_corr(a):
+  '''
+  (2, fields, fields) array with the pearson and spearman correlation of a (rows, fields) block
+  spearman ranks each field on its own valid values, which is exact when no values are missing
+  '''
+  return np.stack([pairwise_corr(a), pairwise_corr(pd.DataFrame(a).rank().to_numpy())])
+
+def pd_grouped_corr(df, group, fields, processes = 1):
+  ''' dict of group: (pearson, spearman) correlation tables of all fields '''
+  fields = list(fields)
+  r = pd_group_map(df, group, fields, block_corr, processes)
+  return {k: (pd.DataFrame(v[0], fields, fields), pd.DataFrame(v[1], fields, fields)) for k,v in r.items()}
+
+class QuantileSketch(object):
+  '''
+  mergeable streaming quantile sketch, in the style of KLL
+  a stack of compactors where each item at level h stands for 2**h values
+  a level holding more than k items is sorted and every other item, starting at a
+  random offset, is promoted to the next level
+  memory is about k * log2(n / k) values. the worst case rank error is n * log2(n / k) / k
+  and typical errors are much lower because the random offsets cancel out
+  '''
+  def __init__(self, k = 2048, seed = None):
+    self.k = k
+    self.n = 0
+    self.min = np.nan
+    self.max = np.nan
+    self.levels = [np.empty(0)]
+    self._rng = np.random.default_rng(seed)
+
+  def update(self, values):
+    values = np.asarray(values, np.float64).ravel()
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+      return self
+    self.n += len(values)
+    self.min = np.fmin(self.min, values.min())
+    self.max = np.fmax(self.max, values.max())
+    self.levels[0] = np.concatenate([self.levels[0], values])
+    return self.compress()
+
+  def compress(self):
+    h = 0
+    while h < len(self.levels):
+      if len(self.levels[h]) > self.k:
+        a = np.sort(self.levels[h])
+        # with a odd count, the largest item stays so no weight is lost
+        self.levels[h] = a[len(a) - len(a) % 2:]
+        if h + 1 == len(self.levels):
+          self.levels.append(np.empty(0))
+        self.levels[h + 1] = np.concatenate([self.levels[h + 1], a[self._rng.integers(2):len(a) - len(a) % 2:2]])
+      h += 1
+    return self
+
+  def merge(self, other):
+    while len(self.levels) < len(other.levels):
+      self.levels.append(np.empty(0))
+    for h in range(len(other.levels)):
+      self.levels[h] = np.concatenate([self.levels[h], other.levels[h]])
+    self.n += other.n
+    self.min = np.fmin(self.min, other.min)
+    self.max = np.fmax(self.max, other.max)
+    return self.compress()
+
+  def quantile(self, q):
+    ''' approximate quantiles, interpolated on the cumulative weights of the retained items '''
+    q = np.asarray(q, np.float64)
+    if self.n == 0:
+      return np.full(q.shape, np.nan)
+    x = np.concatenate(self.levels)
+    w = np.concatenate([np.full(len(self.levels[h]), 2.0 ** h) for h in range(len(self.levels))])
+    o = np.argsort(x)
+    x = x[o]
+    # position of each item on a 0..1 scale, like the linear quantile of numpy
+    cw = np.cumsum(w[o]) - w[o] * 0.5
+    cw = (cw - cw[0]) / max(cw[-1] - cw[0], 1e-300)
+    r = np.interp(q, cw, x)
+    # the extremes are known exactly
+    r = np.where(q <= 0, self.min, np.where(q >= 1, self.max, r))
+    return r
+
+class StreamingStats(object):
+  '''
+  mergeable per group summaries of fields, for tables larger than memory
+  count, mean and sum of squared deviations (Welford / Chan), min, max and a quantile sketch
+  partial results from different chunks or files are combined with merge
+  '''
+  def __init__(self, fields, k = 2048, seed = None):
+    self.fields = list(fields)
+    self.k = k
+    self.seed = seed
+    # group: [n, mean, m2, min, max] arrays with one item per field
+    self.moments = {}
+    # group: [QuantileSketch] one per field
+    self.sketches = {}
+
+  def merge_moments(self, g, n, mean, m2, vmin, vmax):
+    if g not in self.moments:
+      self.moments[g] = [n, mean, m2, vmin, vmax]
+      return
+    na, ma, m2a, mina, maxa = self.moments[g]
+    nt = na + n
+    with np.errstate(invalid='ignore', divide='ignore'):
+      d = np.where(n > 0, mean - np.nan_to_num(ma), 0)
+      f = np.where(nt > 0, n / nt, 0)
+      mt = np.where(na > 0, ma + d * f, mean)
+      m2t = np.nan_to_num(m2a) + np.nan_to_num(m2) + d * d * na * f
+    self.moments[g] = [nt, mt, np.where(nt > 0, m2t, np.nan), np.fmin(mina, vmin), np.fmax(maxa, vmax)]
+
+  def update(self, df, group):
+    ''' fold a chunk of rows '''
+    if not set(self.fields).issubset(df.columns):
+      df = df.reindex(columns=[group] + self.fields)
+    g = df.groupby(group, observed=True, sort=False)[self.fields]
+    n = g.count()
+    mean = g.mean()
+    m2 = g.var(ddof=0) * n
+    vmin = g.min()
+    vmax = g.max()
+    for k in n.index:
+      self.merge_moments(k, n.loc[k].to_numpy(np.float64), mean.loc[k].to_numpy(np.float64), m2.loc[k].to_numpy(np.float64), vmin.loc[k].to_numpy(np.float64), vmax.loc[k].to_numpy(np.float64))
+    for k, i in g.indices.items():
+      if k not in self.sketches:
+        self.sketches[k] = [QuantileSketch(self.k, self.seed) for _ in self.fields]
+      for j in range(len(self.fields)):
+        self.sketches[k][j].update(df[self.fields[j]].to_numpy(np.float64, na_value=np.nan)[i])
+    return self
+
+  def merge(self, other):
+    ''' combine with the summaries of another chunk, file or session '''
+    for k, v in other.moments.items():
+      self.merge_moments(k, *v)
+    for k, v in other.sketches.items():
+      if k not in self.sketches:
+        self.sketches[k] = [QuantileSketch(self.k, self.seed) for _ in self.fields]
+      for j in range(len(self.fields)):
+        self.sketches[k][j].merge(v[j])
+    return self
+
+  def table(self, quantiles = (0.25, 0.5, 0.75), group = None):
+    ''' same layout as pd_grouped_stats '''
+    stats = ['count', 'mean', 'min', 'max', 'var', 'std'] + quantile_labels(quantiles)
+    groups = sorted(self.moments)
+    r = pd.DataFrame(np.nan, pd.Index(groups, name=group), pd.MultiIndex.from_product([self.fields, stats]))
+    for k in groups:
+      n, mean, m2, vmin, vmax = self.moments[k]
+      with np.errstate(invalid='ignore', divide='ignore'):
+        var = np.where(n > 1, m2 / (n - 1), np.nan)
+      for j in range(len(self.fields)):
+        q = self.sketches[k][j].quantile(quantiles)
+        r.loc[k, self.fields[j]] = [n[j], mean[j] if n[j] else np.nan, vmin[j], vmax[j], var[j], np.sqrt(var[j])] + list(q)
+    return r
+
+  def save(self, path):
+    import pickle
+    with open(path, 'wb') as f:
+      pickle.dump(self, f, 4)
+
+  @staticmethod
+  def load(path):
+    import pickle
+    with open(path, 'rb') as f:
+      return pickle.load(f)
+
+def pd_row_hash(df):
+  '''
+  one hash per row, stable across chunks even if a column is read as int in one and float in another
+  '''
+  d = {}
+  for c in df.columns:
+    s = df[c]
+    if pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s):
+      d[c] = s.astype(np.float64)
+    else:
+      d[c] = s.astype(object).where(s.notna(), '').astype(str)
+  return pd.util.hash_pandas_object(pd.DataFrame(d), index=False).to_numpy()
+
+def pd_incremental_fold(df_path, group, fields, state = None, chunksize = 100000, **kwargs):
+  '''
+  fold the rows of a file after the watermark of state into a copy of its statistics
+  returns the new state, or None if the rows up to the watermark are not the same anymore
+  '''
+  import hashlib
+  from _gui import pd_iter_dataframe
+  s = StreamingStats(fields)
+  if state is not None:
+    s.merge(state['stats'])
+  h = hashlib.sha1()
+  rows = 0
+  for df in pd_iter_dataframe(df_path, columns = [group] + list(fields), chunksize = chunksize, **kwargs):
+    i = 0
+    if state is not None and rows < state['rows']:
+      i = min(len(df), state['rows'] - rows)
+      h.update(pd_row_hash(df.iloc[:i]).tobytes())
+      rows += i
+      if rows == state['rows'] and h.hexdigest() != state['digest']:
+        return None
+    if i < len(df):
+      h.update(pd_row_hash(df.iloc[i:]).tobytes())
+      s.update(df.iloc[i:], group)
+      rows += len(df) - i
+  if state is not None and rows < state['rows']:
+    return None
+  return {'rows': rows, 'digest': h.hexdigest(), 'stats': s}
+
+def pd_incremental_stats(df_paths, group, fields, state_path, chunksize = 100000, **kwargs):
+  '''
+  streaming statistics which persist their state with a row watermark and a digest of the rows
+  unchanged files are not read. if rows were only appended, just the new rows are folded
+  into the stored state. any other change to the rows causes a full recompute
+  '''
+  import pickle
+  from _gui import pd_path_list, log
+  settings = repr((group, list(fields), sorted(kwargs.items())))
+  states = {}
+  if os.path.exists(state_path):
+    with open(state_path, 'rb') as f:
+      states = pickle.load(f)
+  r = StreamingStats(fields)
+  for df_path in pd_path_list(df_paths):
+    k = os.path.abspath(df_path)
+    st = os.stat(df_path)
+    fp = (st.st_mtime_ns, st.st_size)
+    state = states.get(k)
+    if state is not None and state['settings'] != settings:
+      state = None
+    if state is not None and state['fingerprint'] == fp:
+      log(df_path, 'unchanged')
+    else:
+      new = pd_incremental_fold(df_path, group, fields, state, chunksize, **kwargs)
+      if new is None:
+        log(df_path, 'rows changed, full recompute')
+        new = pd_incremental_fold(df_path, group, fields, None, chunksize, **kwargs)
+      elif state is None:
+        log(df_path, 'full compute', new['rows'], 'rows')
+      else:
+        log(df_path, new['rows'] - state['rows'], 'rows appended')
+      new['settings'] = settings
+      new['fingerprint'] = fp
+      state = states[k] = new
+    r.merge(state['stats'])
+  with open(state_path, 'wb') as f:
+    pickle.dump(states, f, 4)
+  return r
+
+def raster_bins(x, y, codes, ncodes, bins = 400, extent = None, values = None):
+  '''
+  bin points into a (ncodes, ny, nx) grid with a single bincount over combined (code, cell) indices
+  codes: category of each point, from pd.factorize. points with code -1 are ignored
+  values: if given, the grid holds the mean of values in each cell instead of the count
+  row 0 of the grid is the lowest y
+  returns grid, extent as (x0, y0, x1, y1)
+  '''
+  nx, ny = np.broadcast_to(bins, 2)
+  x = np.asarray(x, np.float64)
+  y = np.asarray(y, np.float64)
+  ok = np.isfinite(x) & np.isfinite(y) & (codes >= 0)
+  if values is not None:
+    values = np.asarray(values, np.float64)
+    ok &= np.isfinite(values)
+    values = values[ok]
+  x = x[ok]
+  y = y[ok]
+  codes = codes[ok]
+  if extent is None:
+    extent = (x.min(), y.min(), x.max(), y.max()) if len(x) else (0, 0, 1, 1)
+  x0, y0, x1, y1 = extent
+  ix = np.clip(((x - x0) / max(x1 - x0, 1e-12) * nx).astype(np.int64), 0, nx - 1)
+  iy = np.clip(((y - y0) / max(y1 - y0, 1e-12) * ny).astype(np.int64), 0, ny - 1)
+  k = (codes.astype(np.int64) * ny + iy) * nx + ix
+  grid = np.bincount(k, minlength=ncodes * ny * nx).reshape(ncodes, ny, nx)
+  if values is not None:
+    with np.errstate(invalid='ignore', divide='ignore'):
+      grid = np.bincount(k, values, ncodes * ny * nx).reshape(ncodes, ny, nx) / grid
+  return grid, extent
+
+def category_colors(n):
+  ''' (n, 3) array of distinct rgb colors '''
+  from matplotlib import colormaps
+  cmap = colormaps['tab10' if n <= 10 else 'tab20']
+  return np.array([cmap(_ % cmap.N)[:3] for _ in range(n)])
+
+def raster_rgba(count, colors):
+  '''
+  (ny, nx, 4) image of a (ncodes, ny, nx) count grid, ready for hv.RGB (top row first)
+  each cell blends the category colors weighted by their counts, and the
+  opacity follows the log of the total count, so sparse and dense areas both show
+  '''
+  total = count.sum(0)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    rgb = np.tensordot(count, colors, axes=(0, 0)) / total[..., None]
+    a = np.log1p(total) / np.log1p(total.max())
+  img = np.concatenate([np.nan_to_num(rgb, nan=1.0), np.where(total > 0, 0.25 + 0.75 * a, 0)[..., None]], axis=-1)
+  return img[::-1]
+
+def hist_edges(a, bins = 'fd', log = False, robust = (0.005, 0.995), max_bins = 200, sample = 200000):
+  '''
+  common bin edges for each column of a (n, fields) array, computed for all columns at once
+  bins: 'fd' for Freedman-Diaconis width, or a fixed number of bins
+  log: bins are uniform in log10 space, values <= 0 are ignored
+  robust: quantiles that bound the range, so a few extreme values do not squash the histogram
+  sample: quantiles are estimated on a even stride of at most this many rows
+  returns lo, width, nbins as arrays with one value per column (lo and width in log10 when log)
+  '''
+  a = np.asarray(a, np.float64)
+  if len(a) == 0:
+    return np.zeros(a.shape[1]), np.ones(a.shape[1]), np.ones(a.shape[1], np.int64)
+  step = max(1, len(a) // sample)
+  a = a[::step]
+  if log:
+    with np.errstate(invalid='ignore', divide='ignore'):
+      a = np.where(a > 0, np.log10(a), np.nan)
+  # freedman-diaconis uses the full count, not the sample size
+  n = np.isfinite(a).sum(0) * step
+  lo, q1, q3, hi = np.nanquantile(a, [robust[0], 0.25, 0.75, robust[1]], axis=0)
+  lo = np.nan_to_num(lo)
+  hi = np.where(hi > lo, hi, lo + 1)
+  if isinstance(bins, str):
+    with np.errstate(invalid='ignore', divide='ignore'):
+      w = 2 * (q3 - q1) / np.cbrt(n)
+      nbins = np.where(w > 0, np.ceil((hi - lo) / w), 10)
+    nbins = np.clip(np.nan_to_num(nbins, nan=10), 1, max_bins).astype(np.int64)
+  else:
+    nbins = np.full(a.shape[1], int(bins), np.int64)
+  return lo, (hi - lo) / nbins, nbins
+
+def pd_histograms(df, group, fields, bins = 'fd', log = False, chunksize = 65536):
+  '''
+  per group histograms of every field on shared edges
+  counts are filled with one bincount over combined (group, field, bin) codes per row chunk
+  values outside the robust range are counted in the first or last bin
+  returns groups, edges, counts where edges[i] and counts[i] (groups, nbins) belong to fields[i]
+  '''
+  codes, groups = pd.factorize(df[group], sort=True)
+  a = np.ascontiguousarray(df[fields].to_numpy(np.float64))
+  lo, width, nbins = hist_edges(a, bins, log)
+  offset = np.concatenate([[0], np.cumsum(nbins)])
+  total = offset[-1]
+  r = np.zeros(len(groups) * total, np.int64)
+  for i in range(0, len(a), chunksize):
+    c = a[i:i + chunksize]
+    if log:
+      with np.errstate(invalid='ignore', divide='ignore'):
+        c = np.where(c > 0, np.log10(c), np.nan)
+    ok = np.isfinite(c) & (codes[i:i + chunksize, None] >= 0)
+    with np.errstate(invalid='ignore'):
+      b = np.clip((c - lo) / width, 0, nbins - 1)
+    b[~ok] = 0
+    k = b.astype(np.int64)
+    k += codes[i:i + chunksize, None] * total + offset[:-1]
+    r += np.bincount(k[ok], minlength=len(r))
+  r = r.reshape(len(groups), total)
+  edges = [lo[j] + width[j] * np.arange(nbins[j] + 1) for j in range(len(fields))]
+  if log:
+    edges = [10 ** _ for _ in edges]
+  return groups, edges, [r[:, offset[j]:offset[j + 1]] for j in range(len(fields))]
+
+def histogram_figure(edges, counts, labels, title = None, layout = 'overlay', log = False):
+  '''
+  matplotlib figure of the histograms of one field, without pyplot global state
+  layout: overlay draws all groups on the same axes, facet draws one axes per group
+  '''
+  from matplotlib.figure import Figure
+  colors = category_colors(len(labels))
+  if layout == 'facet':
+    cols = min(4, max(1, len(labels)))
+    rows = max(1, (len(labels) + cols - 1) // cols)
+    fig = Figure(figsize=(3 * cols, 2.2 * rows + 0.5), constrained_layout=True)
+    axs = fig.subplots(rows, cols, sharex=True, squeeze=False).flat
+    for i in range(len(labels)):
+      axs[i].stairs(counts[i], edges, fill=True, color=colors[i])
+      axs[i].set_title(str(labels[i]), fontsize='small')
+    for ax in axs[len(labels):]:
+      ax.set_visible(False)
+  else:
+    fig = Figure(figsize=(8, 4.5), constrained_layout=True)
+    ax = fig.subplots()
+    for i in range(len(labels)):
+      ax.stairs(counts[i], edges, color=colors[i], label=str(labels[i]))
+    if len(labels):
+      ax.legend(fontsize='small')
+    axs = [ax]
+  if log:
+    for ax in axs:
+      ax.set_xscale('log')
+  if title:
+    fig.suptitle(title)
+  return fig
+
+def pd_box_stats(df, group, fields, whis = 1.5, max_fliers = 100):
+  '''
+  box and whisker summaries of every field per group, in the format of matplotlib Axes.bxp
+  rows are sorted by group once into a (fields, rows) array, so each group of each field
+  is a contiguous block: quartiles come from one sort per group, and whiskers,
+  counts and means of all fields and groups from a few reduceat calls
+  fliers are capped to max_fliers per box, evenly spaced in sorted order so the extremes are kept
+  returns a dict of field: list of dicts with med, q1, q3, whislo, whishi, mean, n, fliers, label
+  '''
+  codes, groups = pd.factorize(df[group], sort=True)
+  g = len(groups)
+  if g == 0:
+    return dict([(v, []) for v in fields])
+  # rows without a group sort first and are left out
+  o = np.argsort(codes, kind='stable')
+  o = o[np.searchsorted(codes[o], 0):]
+  a = df[fields].to_numpy(np.float64).T.take(o, 1)
+  size = np.bincount(codes[o], minlength=g)
+  start = np.concatenate([[0], np.cumsum(size)[:-1]])
+  ok = np.isfinite(a)
+  n = np.add.reduceat(ok, start, 1)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    mean = np.add.reduceat(np.where(ok, a, 0), start, 1) / n
+  # linear interpolated quartiles, same as np.quantile. each group block is sorted
+  # for all fields in one call, nan sort last as inf and are past the n first values
+  q = np.empty((3, len(fields), g))
+  for k in range(g):
+    b = slice(start[k], start[k] + size[k])
+    b = np.sort(np.where(ok[:, b], a[:, b], np.inf), 1)
+    pos = np.multiply.outer([0.25, 0.5, 0.75], np.maximum(n[:, k] - 1, 0))
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, np.maximum(n[:, k] - 1, 0))
+    vlo = np.take_along_axis(b, lo.T, 1).T
+    vhi = np.take_along_axis(b, hi.T, 1).T
+    with np.errstate(invalid='ignore'):
+      q[:, :, k] = np.where(n[:, k] > 0, vlo + (pos - lo) * (vhi - vlo), np.nan)
+  iqr = q[2] - q[0]
+  with np.errstate(invalid='ignore'):
+    out = (a < np.repeat(q[0] - whis * iqr, size, 1)) | (a > np.repeat(q[2] + whis * iqr, size, 1))
+  a_in = np.where(out, np.nan, a)
+  whislo = np.fmin.reduceat(a_in, start, 1)
+  whishi = np.fmax.reduceat(a_in, start, 1)
+  r = {}
+  for j,v in enumerate(fields):
+    i = np.flatnonzero(out[j])
+    split = np.searchsorted(i, start.tolist() + [a.shape[1]])
+    r[v] = []
+    for k in range(g):
+      fliers = np.sort(a[j, i[split[k]:split[k + 1]]])
+      if len(fliers) > max_fliers:
+        fliers = fliers[np.linspace(0, len(fliers) - 1, max_fliers).round().astype(np.int64)]
+      r[v].append({'label': str(groups[k]), 'n': int(n[j, k]), 'mean': mean[j, k], 'q1': q[0, j, k], 'med': q[1, j, k], 'q3': q[2, j, k], 'whislo': whislo[j, k], 'whishi': whishi[j, k], 'fliers': fliers})
+  return r
+
+def box_figure(stats, title = None):
+  '''
+  matplotlib figure of precomputed box summaries, without pyplot global state
+  '''
+  from matplotlib.figure import Figure
+  stats = [_ for _ in stats if _['n'] > 0]
+  fig = Figure(figsize=(max(4, 0.6 * len(stats) + 2), 4.5), constrained_layout=True)
+  ax = fig.subplots()
+  if stats:
+    r = ax.bxp(stats, patch_artist=True, showmeans=True, flierprops={'markersize': 3, 'alpha': 0.5})
+    for b,c in zip(r['boxes'], category_colors(len(stats))):
+      b.set_facecolor(c)
+    ax.tick_params('x', labelrotation=90)
+  if title:
+    ax.set_title(title)
+  return fig
+
+# figure render pool. the workers unpickle render_figure and the figure functions
+# from this module, so they import numpy, pandas and matplotlib but not panel
+render_pool = None
+# size of the render pool, None for one process per cpu and 0 to render in this process
+render_processes = None
+# pyplot and its rc settings are process global, so backend setup and every
+# matplotlib render of concurrent steps (run_dag threads) take this lock
+plot_lock = threading.Lock()
+
+def render_figure(fn, args, fmt = 'png'):
+  ''' build a matplotlib figure with fn(*args) and rasterize it. runs in the render pool '''
+  from io import BytesIO
+  fig = fn(*args)
+  f = BytesIO()
+  fig.savefig(f, format=fmt)
+  return fmt, f.getvalue()
+
+def render_submit(fn, *args, fmt = 'png'):
+  '''
+  queue the render of a figure in the render pool, returns a future of the image
+  fn must be a module level function that returns a matplotlib Figure, so it can be pickled
+  pass the future to display, it is resolved in order when the buffer is returned
+  '''
+  global render_pool
+  from concurrent.futures import Future, ProcessPoolExecutor
+  if render_processes == 0:
+    f = Future()
+    # inline renders run in the step threads of run_dag. the lock is never taken
+    # in the pool workers, forked workers could inherit it locked
+    with plot_lock:
+      f.set_result(render_figure(fn, args, fmt))
+    return f
+  if render_pool is None:
+    render_pool = ProcessPoolExecutor(render_processes)
+  return render_pool.submit(render_figure, fn, args, fmt)
+
+def pd_downsample(df, group, budget, fields = (), seed = None, min_group = None):
+  '''
+  boolean mask of at most about budget rows, sampled stratified by group
+  every group gets at least min_group rows (default budget / 2 / groups), or all of its rows if
+  it has fewer, and the rest of the budget is shared in proportion to the group sizes
+  the rows with the min and max of each of fields in each group are always kept, on top of the budget
+  rows without a group are a group of their own. same seed, same rows
+  O(n): a random permutation and a hash based running count per group, no sorting
+  '''
+  n = len(df)
+  if n <= budget:
+    return np.ones(n, np.bool_)
+  codes, groups = pd.factorize(df[group])
+  g = len(groups) + 1
+  codes = np.where(codes < 0, g - 1, codes)
+  size = np.bincount(codes, minlength=g)
+  if min_group is None:
+    min_group = budget // (2 * np.count_nonzero(size))
+  quota = np.minimum(size, min_group)
+  rest = size - quota
+  if rest.sum():
+    quota += np.floor(rest * (max(0, budget - quota.sum()) / rest.sum())).astype(np.int64)
+  perm = np.random.default_rng(seed).permutation(n)
+  rank = pd.Series(codes[perm]).groupby(codes[perm]).cumcount().to_numpy()
+  keep = np.zeros(n, np.bool_)
+  keep[perm[rank < quota[codes[perm]]]] = True
+  if len(fields):
+    a = df[list(fields)].to_numpy(np.float64)
+    # nan filled with inf, so all nan groups pick a row that is then skipped
+    for e,fill in [('idxmin', np.inf), ('idxmax', -np.inf)]:
+      e = getattr(pd.DataFrame(np.where(np.isnan(a), fill, a)).groupby(codes), e)().to_numpy()
+      keep[e[np.isfinite(a[e, np.arange(a.shape[1])])]] = True
+  return keep
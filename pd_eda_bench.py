@@ -0,0 +1,112 @@
+#!python
+# benchmarks for the data loading and statistics engines used by the wf_eda steps
+# usage: python pd_eda_bench.py <benchmark> [--rows n]
+
+import os, os.path, time, tempfile
+import numpy as np
+import pandas as pd
+from _gui import log
+
+def sample_table(rows, fields = 3, litos = 8, seed = 0):
+  ''' synthetic drillhole samples with the same layout as vox_samples_rand.xlsx '''
+  rng = np.random.default_rng(seed)
+  df = pd.DataFrame(rng.lognormal(0, 1, (rows, fields)), columns=['grade%d' % (_ + 1) for _ in range(fields)])
+  df.insert(0, 'lito', np.array(['lito%d' % _ for _ in range(litos)])[rng.integers(0, litos, rows)])
+  df.insert(1, 'length', rng.uniform(0.5, 2, rows))
+  for c in 'xyz':
+    df[c] = rng.uniform(0, 1000, rows)
+  return df
+
+def timeit(label, fn, *args, **kwargs):
+  t = time.perf_counter()
+  r = fn(*args, **kwargs)
+  t = time.perf_counter() - t
+  log('%-40s %8.3fs' % (label, t))
+  return t, r
+
+def bench_csv(rows = 1000000):
+  from _gui import pd_read_csv, _csv_dialect
+  df = sample_table(rows)
+  with tempfile.TemporaryDirectory() as tmp:
+    for sep in [',', ';']:
+      df_path = os.path.join(tmp, 'samples.csv')
+      df.to_csv(df_path, sep=sep, index=False)
+      log('csv', sep, rows, 'rows', '%.1f MB' % (os.path.getsize(df_path) / 2**20))
+      t0, _ = timeit('read_csv sep=None engine=python', pd.read_csv, df_path, sep=None, engine='python', encoding='latin_1')
+      _csv_dialect.clear()
+      t1, _ = timeit('pd_read_csv (first, sniff)', pd_read_csv, df_path)
+      t2, _ = timeit('pd_read_csv engine=c', pd_read_csv, df_path)
+      try:
+        timeit('pd_read_csv engine=pyarrow', pd_read_csv, df_path, engine='pyarrow')
+      except ImportError:
+        log('pyarrow not available')
+      timeit('pd_read_csv chunksize=100000', lambda: sum(map(len, pd_read_csv(df_path, chunksize=100000))))
+      log('speedup c engine: %.1fx' % (t0 / t2))
+
+def bench_stats(rows = 1000000, fields = 50):
+  from pd_eda import pd_grouped_stats
+  def q1(_):
+    return np.nanquantile(_, 0.25)
+  def q2(_):
+    return np.nanquantile(_, 0.5)
+  def q3(_):
+    return np.nanquantile(_, 0.75)
+  df = sample_table(rows, fields)
+  grades = [_ for _ in df if _.startswith('grade')]
+  log('stats', rows, 'rows', fields, 'fields')
+  # the previous per field pivot_table is timed on a few fields and extrapolated
+  n = min(5, fields)
+  t0, _ = timeit('pivot_table, %d fields' % n, lambda: [pd.DataFrame.pivot_table(df, v, 'lito', [], [pd.Series.count, pd.Series.mean, pd.Series.min, pd.Series.max, pd.Series.var, pd.Series.std, q1, q2, q3]) for v in grades[:n]])
+  t0 = t0 * fields / n
+  log('%-40s %8.3fs' % ('pivot_table, %d fields (extrapolated)' % fields, t0))
+  t1, _ = timeit('pd_grouped_stats, %d fields' % fields, pd_grouped_stats, df, 'lito', grades)
+  log('speedup: %.1fx' % (t0 / t1))
+
+def bench_histogram(rows = 1000000, fields = 50):
+  from pd_eda import pd_histograms
+  df = sample_table(rows, fields)
+  grades = [_ for _ in df if _.startswith('grade')]
+  log('histogram', rows, 'rows', fields, 'fields')
+  def loop(edges):
+    # one np.histogram per field and lithology on the same edges
+    return [[np.histogram(np.clip(s, e[0], e[-1]), e)[0] for _,s in df.groupby('lito')[v]] for v,e in zip(grades, edges)]
+  _, (groups, edges, counts) = timeit('pd_histograms, %d fields' % fields, pd_histograms, df, 'lito', grades)
+  t0, _ = timeit('np.histogram loop, edges given', loop, edges)
+  t1, _ = timeit('pd_histograms, %d fields' % fields, pd_histograms, df, 'lito', grades)
+  log('speedup: %.1fx' % (t0 / t1))
+
+def bench_box(rows = 1000000, fields = 50):
+  from matplotlib import cbook
+  from pd_eda import pd_box_stats
+  df = sample_table(rows, fields)
+  grades = [_ for _ in df if _.startswith('grade')]
+  log('box', rows, 'rows', fields, 'fields')
+  t0, _ = timeit('cbook.boxplot_stats per field and lithology', lambda: [[cbook.boxplot_stats(s.dropna().values) for _,s in df.groupby('lito')[v]] for v in grades])
+  t1, _ = timeit('pd_box_stats, %d fields' % fields, pd_box_stats, df, 'lito', grades)
+  log('speedup: %.1fx' % (t0 / t1))
+
+def bench_pool(rows = 1000000, fields = 50, litos = 32):
+  from pd_eda import pd_grouped_stats, pd_group_map, block_stats
+  df = sample_table(rows, fields, litos)
+  grades = [_ for _ in df if _.startswith('grade')]
+  log('pool', rows, 'rows', fields, 'fields', litos, 'lithologies', os.cpu_count(), 'cpus')
+  timeit('pd_grouped_stats groupby', pd_grouped_stats, df, 'lito', grades)
+  t0, _ = timeit('pd_group_map serial', pd_group_map, df, 'lito', grades, block_stats, 1, [0.25, 0.5, 0.75])
+  p = 2
+  while p <= os.cpu_count():
+    t, _ = timeit('pd_grouped_stats %d processes' % p, pd_grouped_stats, df, 'lito', grades, processes = p)
+    log('scaling %d processes: %.2fx' % (p, t0 / t))
+    if p >= os.cpu_count():
+      break
+    p = min(p * 2, os.cpu_count())
+
+if __name__=='__main__':
+  import argparse
+  parser = argparse.ArgumentParser()
+  parser.add_argument('benchmark', choices=[_[6:] for _ in dir() if _.startswith('bench_')])
+  parser.add_argument('--rows', type=int)
+  args = parser.parse_args()
+  kwargs = {}
+  if args.rows:
+    kwargs['rows'] = args.rows
+  globals()['bench_' + args.benchmark](**kwargs)
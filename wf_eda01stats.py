@@ -1,28 +1,38 @@
 #!python
 
+inputs = ['sample_db', 'null_values', 'compact', 'lito_field', 'length_field', 'grade_fields', 'streaming', 'bootstrap', 'seed', 'processes']
+outputs = ['lito_stats']
+
 def main(self = None):
-  def q1(_):
-    return np.nanquantile(_, 0.25)
-  def q2(_):
-    return np.nanquantile(_, 0.5)
-  def q3(_):
-    return np.nanquantile(_, 0.75)
   if self is None:
     return
-  from workflowform import display, FeedBackText
+  from workflowform import display, FeedBackText, plot_extension
   from IPython.display import Markdown
   import numpy as np
   import pandas as pd
-  import holoviews as hv
-  hv.extension('matplotlib')
+  from pd_eda import eda_columns, eda_compact, pd_grouped_stats, pd_weighted_stats, pd_incremental_stats, pd_bootstrap_ci
+  hv = plot_extension()
   display(FeedBackText(self, name = self.step_name))
-  df = pd.read_excel(self.get('sample_db'))
-  df.mask(df == -99, inplace=True)
-  display(hv.Bars(df, [self.get('lito_field')],[self.get('length_field')], label='%s ✕ %s' % (self.get('lito_field'), self.get('length_field'))).aggregate(function=np.nansum))
+  if self.get('streaming'):
+    # sample_db is read in chunks into mergeable summaries, quantiles are approximate
+    # the summaries are kept between runs, so only appended rows are read again
+    pt = pd_incremental_stats(self.get('sample_db'), self.get('lito_field'), list(self.get('grade_fields')) + [self.get('length_field')], self.step_name + '.stats', null_values = self.get('null_values')).table(group = self.get('lito_field'))
+    bars = (pt[self.get('length_field'), 'count'] * pt[self.get('length_field'), 'mean']).rename(self.get('length_field')).reset_index()
+    display(hv.Bars(bars, [self.get('lito_field')],[self.get('length_field')], label='%s ✕ %s' % (self.get('lito_field'), self.get('length_field'))))
+  else:
+    df = self.get_dataframe('sample_db', eda_columns(self), eda_compact(self))
+    display(hv.Bars(df, [self.get('lito_field')],[self.get('length_field')], label='%s ✕ %s' % (self.get('lito_field'), self.get('length_field'))).aggregate(function=np.nansum))
+    pt = pd_grouped_stats(df, self.get('lito_field'), self.get('grade_fields'), processes = self.get('processes'))
+    if self.get('length_field') in df:
+      # length weighted statistics, side by side with the unweighted
+      pt = pd.concat([pt, pd_weighted_stats(df, self.get('lito_field'), self.get('grade_fields'), self.get('length_field'))], axis=1)
+    if self.get('bootstrap'):
+      # 95% confidence intervals of the mean and quartiles
+      pt = pd.concat([pt, pd_bootstrap_ci(df, self.get('lito_field'), self.get('grade_fields'), ('mean', 'q1', 'q2', 'q3'), seed = self.get('seed'), processes = self.get('processes') or 1)], axis=1)
+  self.publish('lito_stats', pt)
   for v in self.get('grade_fields'):
     display(Markdown('### ' + v))
-    pt = pd.DataFrame.pivot_table(df, v, self.get('lito_field'), [], [pd.Series.count, pd.Series.mean, pd.Series.min, pd.Series.max, pd.Series.var, pd.Series.std, q1, q2, q3])
-    display(pt.set_axis(pt.columns.levels[0], axis=1))
+    display(pt[v])
   return display()
 
 if __name__=='__main__':
@@ -1,21 +1,23 @@
 #!python
 
+inputs = ['sample_db', 'null_values', 'compact', 'lito_field', 'length_field', 'grade_fields']
+
 def main(self = None):
   if self is None:
     return
-  from workflowform import display, FeedBackText
+  from workflowform import display, FeedBackText, plot_extension
   from IPython.display import Markdown
   import numpy as np
-  import pandas as pd
+  from pd_eda import eda_columns, eda_compact, pd_box_stats, box_figure, render_submit
   from _gui import pd_detect_xyz
-  import holoviews as hv
-  hv.extension('matplotlib')
-  df = pd.read_excel(self.get('sample_db'))
-  df.mask(df == -99, inplace=True)
+  plot_extension()
+  df = self.get_dataframe('sample_db', eda_columns(self), eda_compact(self))
   xyz = pd_detect_xyz(df)
   display(FeedBackText(self, name = self.step_name))
-  for v in self.get('grade_fields'):
-    display(hv.BoxWhisker(df, kdims=self.get('lito_field'), vdims=v, label=v))
+  fields = self.get('grade_fields')
+  stats = pd_box_stats(df, self.get('lito_field'), fields)
+  for v in fields:
+    display(render_submit(box_figure, stats[v], v))
   return display()
 
 if __name__=='__main__':
@@ -1,22 +1,23 @@
 #!python
 
+inputs = ['sample_db', 'null_values', 'compact', 'lito_field', 'length_field', 'grade_fields', 'histogram_bins', 'histogram_log', 'histogram_layout']
+
 def main(self = None):
   if self is None:
     return
-  from workflowform import display, FeedBackText
+  from workflowform import display, FeedBackText, plot_extension
   from IPython.display import Markdown
-  import numpy as np
-  import pandas as pd
+  from pd_eda import eda_columns, eda_compact, pd_histograms, histogram_figure, render_submit
   from _gui import pd_detect_xyz
-  import holoviews as hv
-  hv.extension('matplotlib')
-  df = pd.read_excel(self.get('sample_db'))
-  df.mask(df == -99, inplace=True)
+  plot_extension()
+  df = self.get_dataframe('sample_db', eda_columns(self), eda_compact(self))
   xyz = pd_detect_xyz(df)
   display(FeedBackText(self, name = self.step_name))
-  for v in self.get('grade_fields'):
-    s = df[v].values
-    display(hv.Histogram(np.histogram(s[np.isfinite(s)]), label=v).opts(fig_size=150))
+  fields = self.get('grade_fields')
+  log = bool(self.get('histogram_log'))
+  groups, edges, counts = pd_histograms(df, self.get('lito_field'), fields, self.get('histogram_bins') or 'fd', log)
+  for i in range(len(fields)):
+    display(render_submit(histogram_figure, edges[i], counts[i], groups, fields[i], self.get('histogram_layout') or 'overlay', log))
   return display()
 
 if __name__=='__main__':
@@ -1,20 +1,39 @@
 #!python
 
+inputs = ['sample_db', 'null_values', 'compact', 'lito_field', 'length_field', 'grade_fields', 'raster_threshold', 'raster_field', 'point_budget', 'seed']
+
 def main(self = None):
   if self is None:
     return
-  from workflowform import display, FeedBackText
+  from workflowform import display, FeedBackText, plot_extension
   from IPython.display import Markdown
   import numpy as np
   import pandas as pd
+  from pd_eda import eda_columns, eda_compact, raster_bins, raster_rgba, category_colors, pd_downsample
   from _gui import pd_detect_xyz
-  import holoviews as hv
-  hv.extension('matplotlib')
-  df = pd.read_excel(self.get('sample_db'))
-  df.mask(df == -99, inplace=True)
+  hv = plot_extension()
+  df = self.get_dataframe('sample_db', eda_columns(self), eda_compact(self))
   xyz = pd_detect_xyz(df)
   display(FeedBackText(self, name = self.step_name))
-  display(hv.Overlay([hv.Scatter(rd, xyz[0], xyz[1], label=ri) for ri,rd in df.groupby(self.get('lito_field'))]).opts(fig_size=150, title='%s %s ✕ %s' % (self.get('lito_field'), xyz[0], xyz[1])))
+  title = '%s %s ✕ %s' % (self.get('lito_field'), xyz[0], xyz[1])
+  if len(df) > (self.get('raster_threshold') or 200000):
+    # too many points to draw one by one, bin them into a image per lithology
+    codes, uniques = pd.factorize(df[self.get('lito_field')], sort=True)
+    v = self.get('raster_field')
+    grid, extent = raster_bins(df[xyz[0]], df[xyz[1]], codes, len(uniques), 400, values = df[v] if v else None)
+    if v:
+      display(hv.Layout([hv.Image(grid[i][::-1], bounds=extent, kdims=xyz[:2], vdims=v, label=str(uniques[i])).opts(cmap='viridis', colorbar=True) for i in range(len(uniques))]).opts(title='%s mean %s' % (title, v)))
+    else:
+      colors = category_colors(len(uniques))
+      # empty scatters provide the color key
+      display(hv.Overlay([hv.RGB(raster_rgba(grid, colors), bounds=extent, kdims=xyz[:2])] + [hv.Scatter([], label=str(uniques[i])).opts(color=tuple(colors[i])) for i in range(len(uniques))]).opts(fig_size=150, title=title))
+  else:
+    # cap the points drawn, keeping rare lithologies and the extremes of each field
+    keep = pd_downsample(df, self.get('lito_field'), self.get('point_budget') or 50000, list(xyz[:2]) + self.get('grade_fields'), self.get('seed'))
+    if not keep.all():
+      display(Markdown('%d of %d points drawn, %d dropped by point_budget' % (keep.sum(), len(keep), len(keep) - keep.sum())))
+      df = df[keep]
+    display(hv.Overlay([hv.Scatter(rd, xyz[0], xyz[1], label=ri) for ri,rd in df.groupby(self.get('lito_field'), observed=True)]).opts(fig_size=150, title=title))
   return display()
 
 if __name__=='__main__':
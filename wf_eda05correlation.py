@@ -0,0 +1,26 @@
+#!python
+
+inputs = ['sample_db', 'null_values', 'compact', 'lito_field', 'length_field', 'grade_fields', 'processes']
+
+def main(self = None):
+  if self is None:
+    return
+  from workflowform import display, FeedBackText, plot_extension
+  from IPython.display import Markdown
+  from pd_eda import eda_columns, eda_compact, pd_grouped_corr
+  hv = plot_extension()
+  display(FeedBackText(self, name = self.step_name))
+  df = self.get_dataframe('sample_db', eda_columns(self), eda_compact(self))
+  fields = self.get('grade_fields')
+  for k, r in pd_grouped_corr(df, self.get('lito_field'), fields, self.get('processes') or 1).items():
+    display(Markdown('### %s = %s' % (self.get('lito_field'), k)))
+    p = []
+    for label, c in zip(['pearson', 'spearman'], r):
+      c = c.rename_axis('y').reset_index().melt('y', var_name='x', value_name='r')
+      p.append(hv.HeatMap(c, ['x', 'y'], 'r', label=label).opts(cmap='RdBu_r', clim=(-1, 1), colorbar=True, xrotation=90, show_values=len(fields) <= 12, fig_size=150))
+    display(hv.Layout(p))
+  return display()
+
+if __name__=='__main__':
+  from workflowform import run_step
+  run_step('wf_eda05correlation', 'wf_eda.yaml')
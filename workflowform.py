@@ -1,8 +1,9 @@
 #!python
 # Parameterized form with yaml persistence
 
-import os, os.path, param, yaml, logging, time
+import os, os.path, param, yaml, logging, time, threading
 from functools import partial
+from collections import OrderedDict
 import panel as pn
 webview = None
 pn.extension('vtk')
@@ -50,6 +51,128 @@ def webview_create_file_dialog(dialog_type, allow_multiple = False):
   # fall back to Winforms
   return winforms_file_dialog(dialog_type, allow_multipe)  
 
+class DataFrameCache(object):
+  '''
+  session wide cache of loaded and null masked sample tables
+  entries are keyed on file path, mtime, size, the sentinel and compact settings and columns
+  a request is also served by a uncompacted entry or one holding a superset of its columns
+  concurrent requests for the same data wait for a single load
+  least recently used entries are evicted when the memory budget (MB) is exceeded
+  '''
+  def __init__(self, budget = 1024):
+    self.budget = budget
+    self._d = OrderedDict()
+    self._inflight = {}
+    self._lock = threading.RLock()
+
+  @staticmethod
+  def fingerprint(df_path):
+    if isinstance(df_path, (list, tuple)):
+      return sum([DataFrameCache.fingerprint(_) for _ in df_path], ())
+    st = os.stat(df_path)
+    return (os.path.abspath(df_path), st.st_mtime_ns, st.st_size)
+
+  def key(self, df_path, null_values = None, columns = None, compact = None):
+    if null_values is None:
+      null_values = [-99]
+    if columns is not None:
+      columns = tuple(columns)
+    return self.fingerprint(df_path) + (repr(null_values), repr(compact), columns)
+
+  def nbytes(self):
+    return sum([_[1] for _ in self._d.values()])
+
+  @staticmethod
+  def covers(e, k):
+    ''' entry key e can serve request key k '''
+    return e[:-2] == k[:-2] and e[-2] in (k[-2], 'None') and (e[-1] is None or k[-1] is not None and set(e[-1]).issuperset(k[-1]))
+
+  def lookup(self, k):
+    ''' exact match, or the most recent entry covering the request '''
+    with self._lock:
+      if k in self._d:
+        self._d.move_to_end(k)
+        return self._d[k][0], k
+      for e in reversed(self._d):
+        if self.covers(e, k):
+          self._d.move_to_end(e)
+          return self._d[e][0], e
+    return None, None
+
+  def get(self, df_path, null_values = None, columns = None, compact = None):
+    from _gui import pd_path_list, pd_compact
+    df_path = pd_path_list(df_path)
+    if len(df_path) == 1:
+      df_path = df_path[0]
+    k = self.key(df_path, null_values, columns, compact)
+    while True:
+      df, e = self.lookup(k)
+      if df is not None:
+        break
+      with self._lock:
+        w = [v for e,v in self._inflight.items() if self.covers(e, k)]
+        if not w:
+          self._inflight[k] = threading.Event()
+      if w:
+        # someone else is already loading this data
+        w[0].wait()
+        continue
+      try:
+        df = self.load(df_path, null_values, columns, compact)
+        self.put(k, df)
+        e = k
+      finally:
+        with self._lock:
+          self._inflight.pop(k).set()
+      break
+    if e != k:
+      if columns is not None:
+        df = df[[_ for _ in columns if _ in df]]
+      if e[-2] != k[-2]:
+        # compacting a loaded table is cheaper than parsing the file again
+        df = pd_compact(df.copy(), **(compact if isinstance(compact, dict) else {}))
+        self.put(k, df)
+    return df
+
+  def load(self, df_path, null_values = None, columns = None, compact = None):
+    from _gui import pd_load_dataframe, pd_load_dataframes
+    t = time.perf_counter()
+    if isinstance(df_path, list):
+      df = pd_load_dataframes(df_path, columns = columns, null_values = null_values, compact = compact)
+    else:
+      df = pd_load_dataframe(df_path, columns = columns, null_values = null_values, compact = compact)
+    log('loaded', df_path, df.shape, '%.3fs' % (time.perf_counter() - t))
+    return df
+
+  def put(self, k, df):
+    with self._lock:
+      self._d[k] = (df, int(df.memory_usage(deep=True).sum()))
+      self._d.move_to_end(k)
+      # always keep at least the newest entry, even if it alone exceeds the budget
+      while len(self._d) > 1 and self.nbytes() > self.budget * 2**20:
+        self._d.popitem(False)
+
+  def discard(self, df_path):
+    ''' remove all entries of a file '''
+    from _gui import pd_path_list
+    df_path = pd_path_list(df_path)
+    if len(df_path) == 1:
+      df_path = df_path[0]
+    with self._lock:
+      try:
+        fp = self.fingerprint(df_path)
+      except OSError:
+        return
+      for e in [_ for _ in self._d if _[:len(fp)] == fp]:
+        del self._d[e]
+
+  def clear(self):
+    with self._lock:
+      self._d.clear()
+
+df_cache = DataFrameCache()
+prefetch_pool = None
+
 def pn_iframe_html(p):
   return pn.pane.HTML(f'<iframe src="~/{p}" style="height:100%; width:100%"></iframe>', sizing_mode='stretch_both')
 
@@ -81,14 +204,21 @@ class WorkFlowBase(list, param.Parameterized):
 
   def items(self, event = None):
     return [(k, self.get(k)) for k,t,w in self]
+
+  def get_dataframe(self, key = 'sample_db', columns = None, compact = None):
+    ''' table pointed by a form field, loaded through the session cache. shared, do not modify inplace '''
+    return df_cache.get(self.get(key), self.get('null_values'), columns, compact)
   
 class WorkFlowForm(WorkFlowBase):
   _file = None
   _mode = None
   _qta = None
+  _prefetch = None
 
-  def __init__(self, file = None, mode = None):
+  def __init__(self, file = None, mode = None, prefetch = True):
     super().__init__()
+    # None disables the background loading of file fields
+    self._prefetch = {} if prefetch else None
     if file is not None:
       self._file = file
     if self._mode is None:
@@ -115,6 +245,51 @@ class WorkFlowForm(WorkFlowBase):
         data = yaml.safe_load(f)
     for k,t,v in data:
       self.append([k, t, self.widget(t, v)])
+    if self._prefetch is None:
+      return
+    # only the tables the steps load: file fields declared as a step input, except outputs
+    inputs = set()
+    for s in self.steps():
+      inputs.update(step_spec(s)[0] or [])
+    # after all fields exist, the prefetch reads them to pick the columns
+    for k,t,w in self:
+      if t.endswith('FileSelector') and k in inputs and not k.lower().startswith('output'):
+        w.param.watch(partial(self.prefetch, k), 'value')
+        self.prefetch(k)
+
+  def prefetch(self, k, event = None):
+    ''' start loading the file of a form field into the session cache, in background '''
+    global prefetch_pool
+    import re
+    from _gui import pd_path_list, pd_cache_re
+    if self._prefetch is None:
+      return
+    f = self._prefetch.pop(k, None)
+    if f is not None:
+      # only effective if not started yet. a running load is discarded when done
+      f.cancel()
+    v = self.get(k)
+    # tabular formats with a column projection only
+    if not v or not all([os.path.isfile(_) and re.search(pd_cache_re, _, re.IGNORECASE) for _ in pd_path_list(v)]):
+      return
+    if prefetch_pool is None:
+      from concurrent.futures import ThreadPoolExecutor
+      prefetch_pool = ThreadPoolExecutor(2, 'prefetch')
+    self._prefetch[k] = prefetch_pool.submit(self.prefetch_run, k, v)
+
+  def prefetch_run(self, k, v):
+    from pd_eda import eda_columns, eda_compact
+    # without the eda fields the projection is empty and the whole table would be read
+    if not any([self.get(_) for _ in ['lito_field', 'length_field', 'grade_fields']]):
+      return
+    try:
+      # same projection and compact settings as the steps, so the full table is not kept
+      self.get_dataframe(k, eda_columns(self, k), eda_compact(self))
+    except Exception as e:
+      log('prefetch failed', v, e)
+    if self.get(k) != v:
+      log('prefetch stale', v)
+      df_cache.discard(v)
 
   def widget(self, t, v):
     w = None
@@ -152,7 +327,13 @@ class WorkFlowForm(WorkFlowBase):
       obj_icon = event.obj.icon
       event.obj.icon='hourglass'
       event.obj.disabled = True
-      run_step(os.path.splitext(os.path.basename(self._file))[0], self)
+      step_name = os.path.splitext(os.path.basename(self._file))[0]
+      if os.path.exists(step_name + '.py'):
+        run_step(step_name, self)
+      else:
+        # no script for the form itself, render all its steps
+        for r in run_dag(self):
+          log('%s %.3fs %s' % r)
       event.obj.disabled = False
       event.obj.icon=obj_icon
 
@@ -240,6 +421,205 @@ class WorkFlowForm(WorkFlowBase):
   panel = __panel__
   __call__ = __panel__
 
+# persistent cache of step results, as html files
+step_cache_dir = '.wf_cache'
+step_cache_mb = 256
+
+def step_spec(step_name):
+  '''
+  declared inputs and outputs of a step module
+  inputs: module list of the form fields and upstream outputs the step reads. a change in
+  other fields does not render it again. None, when not declared, means every form field
+  outputs: module list of the names the step publishes for the steps that have them as input
+  '''
+  if not os.path.exists(step_name + '.py'):
+    return None, []
+  step = __import__(step_name)
+  return getattr(step, 'inputs', None), list(getattr(step, 'outputs', []))
+
+def step_graph(form, steps = None):
+  '''
+  dependency graph of steps: step -> set of steps that produce one of its inputs
+  steps: the steps in the graph, default all Filename fields of the form
+  raises ValueError on a cycle
+  '''
+  if steps is None:
+    steps = [k for k,t,w in form if t == 'Filename']
+  producer = {}
+  for s in steps:
+    for o in step_spec(s)[1]:
+      producer[o] = s
+  r = {}
+  for s in steps:
+    r[s] = set([producer[_] for _ in step_spec(s)[0] or [] if _ in producer and producer[_] != s])
+  step_order(r)
+  return r
+
+def step_order(graph):
+  ''' steps of a graph sorted so each step comes after its inputs, otherwise in the original order '''
+  r = []
+  while len(r) < len(graph):
+    ready = [s for s in graph if s not in r and graph[s].issubset(r)]
+    if not ready:
+      raise ValueError('step dependency cycle: ' + ', '.join([s for s in graph if s not in r]))
+    r.append(ready[0])
+  return r
+
+def step_components(graph):
+  ''' groups of steps connected by inputs, each in graph order '''
+  order = step_order(graph)
+  group = {s: s for s in order}
+  def root(s):
+    while group[s] != s:
+      s = group[s]
+    return s
+  for s in order:
+    for u in graph[s]:
+      group[root(u)] = root(s)
+  r = {}
+  for s in order:
+    r.setdefault(root(s), []).append(s)
+  return list(r.values())
+
+# outputs published by steps as (producer step_cache_key, value), and the signature of each step on its last dag run
+step_results = {}
+step_signatures = {}
+def dag_step(form, step_name, k, force = False):
+  ''' run one step for run_dag, returns step name, seconds, status '''
+  import shutil
+  t = time.perf_counter()
+  status = 'ok'
+  try:
+    step = WorkFlowStep.factory(step_name, form)
+    html = None if force or k is None else step_cache_get(k)
+    if html:
+      shutil.copyfile(html, step_name + '.html')
+      status = 'cached'
+    elif k is None:
+      step.panel()
+    else:
+      s_step_run(step, k)
+  except Exception as e:
+    log(step_name, 'failed', repr(e))
+    status = repr(e)
+  return step_name, time.perf_counter() - t, status
+
+def run_dag(form, steps = None, threads = None):
+  '''
+  run the enabled steps of a form in dependency order, independent steps concurrently in threads
+  a step runs only if its signature (step_cache_key) changed since the last run_dag in this
+  process, which includes the signatures of its upstream steps, so changes flow downstream
+  steps whose outputs feed a running step are run for real, not copied from the step cache
+  threads: default of ThreadPoolExecutor. steps mostly wait on numpy, pandas and files
+  returns a list of step name, seconds, status in graph order
+  '''
+  from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+  if steps is None:
+    steps = [k for k,t,w in form if t == 'Filename' and form.get(k)]
+  graph = step_graph(form, steps)
+  order = step_order(graph)
+  keys = dict([(s, step_cache_key(WorkFlowStep.factory(s, form)) if os.path.exists(s + '.py') else None) for s in order])
+  run = set([s for s in order if keys[s] is None or step_signatures.get(s) != keys[s] or not os.path.exists(s + '.html')])
+  # results only live in memory, so producers of a running step also run when theirs are gone
+  # or were published under a different signature
+  for s in order[::-1]:
+    if s in run:
+      run.update([u for u in graph[s] if any([step_results.get(_, (None,))[0] != keys[u] for _ in step_spec(u)[1]])])
+  needed = set([u for s in run for u in graph[s]])
+  r = {}
+  for s in order:
+    if s not in run:
+      r[s] = (s, 0.0, 'unchanged')
+  running = {}
+  with ThreadPoolExecutor(threads) as pool:
+    while len(r) < len(order):
+      for s in order:
+        if s in r or s in running.values() or not graph[s].issubset(r):
+          continue
+        failed = [u for u in graph[s] if r[u][2] not in ('ok', 'cached', 'unchanged')]
+        if failed:
+          r[s] = (s, 0.0, 'skipped, failed input ' + failed[0])
+        else:
+          running[pool.submit(dag_step, form, s, keys[s], s in needed)] = s
+      if len(r) == len(order):
+        break
+      done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+      for f in done:
+        s = running.pop(f)
+        r[s] = f.result()
+        if r[s][2] in ('ok', 'cached'):
+          step_signatures[s] = keys[s]
+  return [r[s] for s in order]
+
+def step_cache_key(self):
+  '''
+  hash of the step source, the form values it declares as inputs, the fingerprints
+  of its input files and the keys of the upstream steps whose outputs it reads
+  '''
+  import hashlib
+  from _gui import pd_path_list
+  h = hashlib.sha1()
+  with open(self.step_name + '.py', 'rb') as f:
+    h.update(f.read())
+  inputs = step_spec(self.step_name)[0]
+  items = [(k,v) for k,v in self.items() if inputs is None or k in inputs or k == self.step_name]
+  h.update(repr(items).encode())
+  if inputs is not None:
+    for u in sorted(step_graph(self)[self.step_name]):
+      h.update(step_cache_key(WorkFlowStep.factory(u, self)).encode())
+  # feedback text is part of the html
+  files = [self.step_name + '.txt']
+  for k,v in items:
+    if isinstance(v, (str, list, tuple)):
+      files.extend([_ for _ in pd_path_list(v) if isinstance(_, str)])
+  for p in files:
+    if os.path.isfile(p):
+      st = os.stat(p)
+      h.update(repr((os.path.abspath(p), st.st_mtime_ns, st.st_size)).encode())
+  return self.step_name + '_' + h.hexdigest()
+
+def step_cache_get(k):
+  p = os.path.join(step_cache_dir, k + '.html')
+  if not os.path.exists(p):
+    return None
+  # access time drives the LRU eviction
+  os.utime(p)
+  return p
+
+def step_cache_put(k, html):
+  import shutil
+  os.makedirs(step_cache_dir, exist_ok=True)
+  shutil.copyfile(html, os.path.join(step_cache_dir, k + '.html'))
+  fl = sorted([os.path.join(step_cache_dir, _) for _ in os.listdir(step_cache_dir)], key=os.path.getmtime)
+  n = sum(map(os.path.getsize, fl))
+  while len(fl) > 1 and n > step_cache_mb * 2**20:
+    n -= os.path.getsize(fl[0])
+    os.remove(fl.pop(0))
+
+def step_cache_invalidate(self, event = None):
+  ''' remove all cached results of a step and render it again '''
+  import glob
+  for p in glob.glob(os.path.join(step_cache_dir, self.step_name + '_*.html')):
+    os.remove(p)
+  log('step cache cleared: ' + self.step_name)
+  return s_step_panel(self)
+
+def s_step_run(self, k = None):
+  ''' call the step function, save the html and store it in the step cache under key k '''
+  step = __import__(self.step_name)
+  # on the step script, call the user defined function with shortest name
+  name = sorted(dir(step), key=len)[0]
+  log(f'calling function {name}')
+  fn = getattr(step, name)
+  r = fn(self)
+  if hasattr(r, 'save'):
+    # the holoviews panes are drawn by matplotlib here, which is not thread safe
+    with plot_lock:
+      r.save(self.step_name + '.html')
+    log('function results saved to file: ' + self.step_name + '.html')
+    step_cache_put(k or step_cache_key(self), self.step_name + '.html')
+  return r
+
 def s_step_panel(self):
   ''' render a step according to the custom payload '''
   r = None
@@ -250,15 +630,21 @@ def s_step_panel(self):
   elif not self.get(self.step_name):
     r = pn.pane.Markdown('# 💤 ' + self.step_name)
   elif os.path.exists(self.step_name + '.py'):
-    step = __import__(self.step_name)
-    # on the step script, call the user defined function with shortest name
-    name = sorted(dir(step), key=len)[0]
-    log(f'calling function {name}')
-    fn = getattr(step, name)
-    r = fn(self)
-    if hasattr(r, 'save'):
-      r.save(self.step_name + '.html')
-      log('function results saved to file: ' + self.step_name + '.html')
+    k = step_cache_key(self)
+    html = step_cache_get(k)
+    if html:
+      import shutil
+      log('cached step results: ' + html)
+      # the report file always holds what the panel shows
+      shutil.copyfile(html, self.step_name + '.html')
+      # the feedback of the html export has no python behind it, so a live one goes on top
+      r = pn.Column(sizing_mode='stretch_both')
+      r.append(FeedBackText(self, name = self.step_name))
+      r.append(pn_iframe_html(html.replace(os.sep, '/')))
+      self._view = r
+      return r
+    r = s_step_run(self, k)
+    self._view = r
   elif os.path.exists(self.step_name + '.ipynb'):
     log('running jupyter notebook ' + self.step_name)
     r = run_notebook(self.step_name + '.ipynb')
@@ -272,6 +658,8 @@ def s_step_panel(self):
 
 class WorkFlowStep(WorkFlowBase):
   step_name = None
+  # panel last returned by s_step_panel, where refresh and feedback save show the new render
+  _view = None
   def __init__(self, form = None):
     super().__init__()
     if form is not None:
@@ -290,6 +678,23 @@ class WorkFlowStep(WorkFlowBase):
 
   panel = __panel__ = s_step_panel
 
+  def publish(self, name, value):
+    ''' keep a declared output in memory under the signature of this step, for the steps that have it as input '''
+    step_results[name] = (step_cache_key(self), value)
+
+  def result(self, name):
+    ''' output of a upstream step. if not in memory or stale, the step that declares it is run first '''
+    for s in step_graph(self)[self.step_name]:
+      if name in step_spec(s)[1]:
+        u = WorkFlowStep.factory(s, self)
+        k = step_cache_key(u)
+        if step_results.get(name, (None,))[0] != k:
+          from concurrent.futures import ThreadPoolExecutor
+          # in its own thread, so the producer has its own display buffer and does not take the items of this step
+          with ThreadPoolExecutor(1) as pool:
+            pool.submit(s_step_run, u, k).result()
+    return step_results.get(name, (None, None))[1]
+
 
 def form_pipeline(form_yaml, step = None):
   form = WorkFlowForm(form_yaml)
@@ -301,7 +706,8 @@ def form_pipeline(form_yaml, step = None):
   else:
     p = pn.pipeline.Pipeline()
     p.add_stage('form', form)
-    for step in form.steps():
+    # inputs before the steps that use them
+    for step in step_order(step_graph(form)):
       step_name = step.removeprefix(base_name)
       p.add_stage(step_name, WorkFlowStep.factory(step, form))
   vt.main.append(p)
@@ -326,7 +732,14 @@ class FeedBackText(param.Parameterized):
     with open(self.name + '.txt', 'w') as f:
       f.write(self._w.value)
     # fire the entire render of this step, so the html output file is updated
-    s_step_panel(self._p)
+    self.render(s_step_panel)
+
+  def render(self, fn, event = None):
+    ''' render the step with fn and show the result in place of the current step panel '''
+    v = getattr(self._p, '_view', None)
+    r = fn(self._p)
+    if v is not None and r is not None:
+      v.objects = [r]
 
   def __panel__(self):
     self.load()
@@ -336,6 +749,9 @@ class FeedBackText(param.Parameterized):
     b = pn.widgets.Button(name='save', icon='device-floppy', min_width=120, icon_size='2em')
     b.on_click(self.save)
     p.append(b)
+    b = pn.widgets.Button(name='refresh', icon='refresh', min_width=120, icon_size='2em')
+    b.on_click(partial(self.render, step_cache_invalidate))
+    p.append(b)
     return p
   panel = __panel__
   __call__ = __panel__
@@ -348,23 +764,121 @@ def run_step(step_name, form):
     step.append([step_name, 'Filename', pn.widgets.Switch(value=True)])
   return step.panel()
 
-display_buffer = None
+plot_backend = None
+# the lock lives in pd_eda with the render pool, so it is one per process also when this file runs as __main__
+from pd_eda import plot_lock
+def plot_extension(backend = 'matplotlib'):
+  ''' load the holoviews plotting backend once per process, returns the holoviews module '''
+  global plot_backend
+  import holoviews as hv
+  with plot_lock:
+    if plot_backend != backend:
+      hv.extension(backend)
+      plot_backend = backend
+  return hv
+
+def plot_warmup(steps = None):
+  '''
+  pay the first render costs before serving: imports, backend setup and font cache
+  steps: list of step names or a form yaml, their modules are imported too
+  call it on the workflowform module the steps import, its plot backend and render pool are the ones they use
+  logs the cold and warm times of rendering the same dummy plot
+  '''
+  from io import BytesIO
+  if isinstance(steps, str):
+    if steps.lower().endswith('yaml') and os.path.exists(steps):
+      with open(steps, 'r') as f:
+        steps = [k for k,t,v in yaml.safe_load(f) if t == 'Filename']
+    else:
+      steps = None
+  t = time.perf_counter()
+  # steps import these inside their function, not at module level
+  import workflowform, pd_eda, _gui
+  for step in steps or []:
+    if os.path.exists(step + '.py'):
+      __import__(step)
+  log('warmup imports: %.3fs' % (time.perf_counter() - t))
+  def render():
+    t = time.perf_counter()
+    hv = plot_extension()
+    fig = hv.render(hv.Curve([0, 1], label='warmup'), backend='matplotlib')
+    fig.savefig(BytesIO(), format='png')
+    return time.perf_counter() - t
+  cold = render()
+  warm = render()
+  log('warmup render: cold %.3fs warm %.3fs' % (cold, warm))
+  # start the render pool workers, so their imports are also done
+  from pd_eda import histogram_figure, render_submit
+  t = time.perf_counter()
+  render_submit(histogram_figure, [0, 1], [[1]], ['warmup']).result()
+  log('warmup render pool: %.3fs' % (time.perf_counter() - t))
+
+def batch_component(form_yaml, steps):
+  '''
+  render a connected group of steps with the dag scheduler, without server. runs in the batch pool
+  returns a list of step name, seconds, status
+  '''
+  import pd_eda
+  # the batch pool already uses the cpus, figures are rendered inline
+  pd_eda.render_processes = 0
+  return run_dag(WorkFlowForm(form_yaml, prefetch = False), steps)
+
+def run_batch(form_yaml, processes = None):
+  '''
+  headless report: render every enabled step of a form, then log a timing summary
+  steps that share results are run together in one process, unrelated groups in parallel
+  returns a list of step name, seconds, status
+  '''
+  import multiprocessing
+  from concurrent.futures import ProcessPoolExecutor, as_completed
+  t = time.perf_counter()
+  # no prefetch, the steps load their data in the workers
+  form = WorkFlowForm(form_yaml, prefetch = False)
+  steps = [_ for _ in form.steps() if form.get(_)]
+  groups = step_components(step_graph(form, steps))
+  r = []
+  # spawn, so workers do not inherit locks or cache state of threads in this process
+  with ProcessPoolExecutor(min(processes or os.cpu_count(), max(1, len(groups))), multiprocessing.get_context('spawn')) as pool:
+    for f in as_completed([pool.submit(batch_component, form_yaml, _) for _ in groups]):
+      for _ in f.result():
+        r.append(_)
+        log('%s %.3fs %s' % _)
+  r.sort(key=lambda _: steps.index(_[0]))
+  log('batch summary', form_yaml)
+  for _ in r:
+    log('%-30s %8.3fs %s' % _)
+  log('%-30s %8.3fs' % ('sum of steps', sum([_[1] for _ in r])))
+  log('%-30s %8.3fs' % ('wall time', time.perf_counter() - t))
+  return r
+
+def display_resolve(data):
+  ''' wait for a render future and wrap the image in a pane '''
+  from concurrent.futures import Future
+  if isinstance(data, Future):
+    fmt, data = data.result()
+    if fmt == 'svg':
+      return pn.pane.SVG(data.decode())
+    return pn.pane.PNG(data)
+  return data
+
+display_local = threading.local()
 def display(data = None):
   ''' 
   drop in replacement for jupyter display but for workflow steps
   if called without arguments: returns a pn.Column with items
   that were queued for display, then clear the queue.
+  items can be render_submit futures, which keep their place in the queue
+  the queue is per thread, so steps can run concurrently
   '''
-  global display_buffer
-  if not isinstance(display_buffer, pn.Column):
-    display_buffer = pn.Column()
+  buffer = getattr(display_local, 'buffer', None)
+  if buffer is None:
+    buffer = display_local.buffer = []
   if data is None:
     # return stored data so far and clear the buffer
-    data = display_buffer
-    display_buffer = None
-    return data
+    display_local.buffer = None
+    return pn.Column(*map(display_resolve, buffer))
   else:
-    display_buffer.append(data)
+    buffer.append(data)
 
 def run_notebook(notebook, output = None, **kwargs):
   import papermill as pm
@@ -386,10 +900,14 @@ def run_notebook(notebook, output = None, **kwargs):
     f.write(r[0])
   return output
 
-def webview_panel_start(p, url = None, port = 5000, headless = None):
+def webview_panel_start(p, url = None, port = 5000, headless = None, warmup = None):
   # server
   if url is None:
     url = f'http://localhost:{port}'
+  if warmup:
+    import workflowform
+    # steps import workflowform, which is a separate module when this file runs as __main__
+    workflowform.plot_warmup(None if warmup is True else warmup)
   if isinstance(p, str) and os.path.exists(p):
     if p.lower().endswith('yaml'):
       p = WorkFlowForm(p, True)
@@ -421,23 +939,46 @@ def mesh_viewer(meshes):
 if __name__=='__main__':
   import argparse, sys
   parser = argparse.ArgumentParser()
-  parser.add_argument('data')
+  parser.add_argument('data', nargs='?')
   parser.add_argument('-n', help='run notebook mode')
   parser.add_argument('--headless', help='start a server and dont open webview window', action='store_true')
   parser.add_argument('-v', help='3d viewer mode', action='store_true')
   parser.add_argument('-p', help='pipeline mode', action='store_true')
   parser.add_argument('--step', help='show only this pipeline step')
+  parser.add_argument('--cache-mb', help='memory budget of the session dataframe cache', type=int)
+  parser.add_argument('--cache-dir', help='enable the columnar sidecar cache on this directory')
+  parser.add_argument('--cache-warm', help='fill the columnar cache for all sample databases in data directory', action='store_true')
+  parser.add_argument('--warmup', help='import steps and render a dummy plot before serving', action='store_true')
+  parser.add_argument('--render-processes', help='size of the figure render pool, 0 renders in the server process', type=int)
+  parser.add_argument('--batch', help='render all enabled steps of this form to html files, without server')
+  parser.add_argument('--batch-processes', help='number of steps rendered at the same time in batch mode', type=int)
   args = parser.parse_args()
-  if args.n is not None:
+  if args.render_processes is not None:
+    import pd_eda
+    pd_eda.render_processes = args.render_processes
+  if args.cache_mb is not None:
+    df_cache.budget = args.cache_mb
+  if args.cache_dir:
+    # environment so worker processes also see it
+    os.environ['PD_CACHE_DIR'] = args.cache_dir
+  if args.batch:
+    r = run_batch(args.batch, args.batch_processes)
+    if any([_[2] not in ('ok', 'cached') for _ in r]):
+      sys.exit(1)
+  elif args.cache_warm:
+    from _gui import pd_cache_warm
+    r = pd_cache_warm(args.data, args.cache_dir)
+    log(len(r), 'files cached')
+  elif args.n is not None:
     print("running notebook:", args.n, "form:", args.data)
     r = run_notebook(args.notebook, form_yaml = args.data)
     if r:
       print("results saved on file:", r)
   elif args.p:
-    webview_panel_start(form_pipeline(args.data, args.step), headless = args.headless)
+    webview_panel_start(form_pipeline(args.data, args.step), headless = args.headless, warmup = args.warmup and args.data)
   elif args.v:
     from pd_vtk import pv_read
     meshes = [pv_read(_) for _ in args.data.split(',')]
-    webview_panel_start(mesh_viewer(meshes), headless = args.headless)
+    webview_panel_start(mesh_viewer(meshes), headless = args.headless, warmup = args.warmup)
   elif args.data:
-    webview_panel_start(args.data, headless = args.headless)
+    webview_panel_start(args.data, headless = args.headless, warmup = args.warmup and args.data)